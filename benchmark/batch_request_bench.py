@@ -0,0 +1,124 @@
+# Benchmark of batched piece requests against one request per piece
+#
+#   python benchmark/batch_request_bench.py --file-size 268435456 --rounds 3
+#
+# A client pulls every piece of a file from a seeder, first with one connection and one
+# "request <piece hash>" per piece, then with "request <file> <piece ids>" batches of
+# --batch-pieces pieces answered as one stream of framed pieces. The time, the throughput,
+# the number of connections and the CPU time of the seeder are reported as JSON.
+
+from typing import List
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream_memory_bench import find_pieces  # noqa: E402
+from swarm_bench import Swarm, free_port, generate_file  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "node"))
+
+from node import NodeUtils  # noqa: E402
+
+
+def fetch_per_piece(address: tuple, piece_hashes: List[str]) -> int:
+    # One connection and one request per piece, as nodes did before batched requests
+    for piece_hash in piece_hashes:
+        digest = hashlib.sha256()
+        with socket.create_connection(address, timeout=30) as sock:
+            sock.sendall(f"request {piece_hash}\n".encode())
+            buffer = bytearray(65536)
+            while count := sock.recv_into(buffer):
+                digest.update(buffer[:count])
+        if digest.hexdigest() != piece_hash:
+            raise ValueError(f"piece {piece_hash[:12]} does not match its hash")
+    return len(piece_hashes)
+
+
+def fetch_batched(
+    address: tuple, file_name: str, piece_hashes: List[str], batch_pieces: int
+) -> int:
+    # One connection per batch, each piece preceded by its header line
+    connections = 0
+    for first in range(0, len(piece_hashes), batch_pieces):
+        piece_ids = range(first, min(first + batch_pieces, len(piece_hashes)))
+        connections += 1
+        with socket.create_connection(address, timeout=30) as sock:
+            spec = NodeUtils.format_piece_ids(piece_ids)
+            sock.sendall(f"request {file_name} {spec}\n".encode())
+            with sock.makefile("rb") as reader:
+                for piece_id in piece_ids:
+                    header = reader.readline().split()
+                    length = int(header[3])
+                    digest = hashlib.sha256(reader.read(length))
+                    if digest.hexdigest() != piece_hashes[piece_id]:
+                        raise ValueError(f"piece {piece_id} does not match its hash")
+    return connections
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="batch_request_bench",
+        description="Compare batched piece requests with one request per piece",
+    )
+    parser.add_argument("--file-size", type=int, default=256 * 1024 * 1024)
+    parser.add_argument("--batch-pieces", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="batch_request_") as work_dir:
+        file_name = "bench-batch.bin"
+        source = os.path.join(work_dir, file_name)
+        generate_file(source, args.file_size, "random", 0)
+
+        swarm = Swarm(work_dir, free_port())
+        try:
+            # The cache is off so both modes send the pieces from the disk
+            seeder = swarm.add_node("seeder", [source], extra_args=["--piece-cache=0"])
+            upload_line = next(
+                line for _, line in seeder.lines if "Upload socket address" in line
+            )
+            host, port = upload_line.split()[-1].rsplit(":", 1)
+            address = (host, int(port))
+            piece_hashes = find_pieces(address, file_name)
+
+            modes = {
+                "per_piece": lambda: fetch_per_piece(address, piece_hashes),
+                "batched": lambda: fetch_batched(
+                    address, file_name, piece_hashes, args.batch_pieces
+                ),
+            }
+            for mode, fetch in modes.items():
+                cpu_before = seeder.usage()["cpu_seconds"]
+                start = time.perf_counter()
+                connections = sum(fetch() for _ in range(args.rounds))
+                seconds = time.perf_counter() - start
+                cpu_after = seeder.usage()["cpu_seconds"]
+                results[mode] = {
+                    "seconds": round(seconds, 2),
+                    "throughput_mb_s": round(
+                        args.rounds * args.file_size / seconds / 2**20, 1
+                    ),
+                    "connections": connections,
+                    "seeder_cpu_seconds": round(cpu_after - cpu_before, 2),
+                }
+        finally:
+            swarm.close()
+
+    results["pieces"] = len(piece_hashes)
+    results["speedup"] = round(
+        results["per_piece"]["seconds"] / results["batched"]["seconds"], 2
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
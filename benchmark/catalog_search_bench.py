@@ -0,0 +1,84 @@
+# Benchmark of discover/search over the tracker's in-memory catalog index
+#
+#   python benchmark/catalog_search_bench.py --files 1000000
+
+from typing import Callable
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "tracker"))
+
+from tracker import CatalogIndex  # noqa: E402
+
+EXTENSIONS = ["pdf", "mp4", "csv", "txt", "log", "tar.gz"]
+
+
+def timed(function: Callable, repeat: int) -> float:
+    # Return the mean time of a call in microseconds
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return round((time.perf_counter() - start) / repeat * 1e6, 1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="catalog_search_bench",
+        description="Measure the latency of discover/search on a large tracker catalog",
+    )
+    parser.add_argument("--files", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    catalog = CatalogIndex()
+    start = time.perf_counter()
+    for index in range(args.files):
+        catalog.add(
+            f"dataset_{rng.randrange(1000):03d}/part_{index:07d}.{rng.choice(EXTENSIONS)}"
+        )
+    build_seconds = time.perf_counter() - start
+
+    queries = {
+        "discover_first_page": lambda: catalog.search("prefix", "", 0, 100),
+        "discover_deep_page": lambda: catalog.search(
+            "prefix", "", args.files // 2, 100
+        ),
+        "prefix": lambda: catalog.search("prefix", "dataset_042/", 0, 100),
+        "substring_rare": lambda: catalog.search("substring", "part_0123456", 0, 100),
+        "substring_common": lambda: catalog.search("substring", "_0123", 0, 100),
+        "glob": lambda: catalog.search("glob", "dataset_04?/part_00001*.csv", 0, 100),
+        "add_remove": lambda: (
+            catalog.add("dataset_500/new.bin"),
+            catalog.remove("dataset_500/new.bin"),
+        ),
+        # A search right after a publish or an expiry changed the catalog
+        "substring_after_change": lambda: (
+            catalog.add("dataset_500/new.bin"),
+            catalog.search("substring", "part_0123456", 0, 100),
+            catalog.remove("dataset_500/new.bin"),
+        ),
+        "glob_after_change": lambda: (
+            catalog.add("dataset_500/new.bin"),
+            catalog.search("glob", "dataset_04?/part_00001*.csv", 0, 100),
+            catalog.remove("dataset_500/new.bin"),
+        ),
+    }
+    catalog.search("substring", "warm up", 0, 1)
+    result = {
+        "catalog_size": len(catalog),
+        "build_seconds": round(build_seconds, 2),
+        "latency_us": {
+            name: timed(query, args.repeat) for name, query in queries.items()
+        },
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Benchmark of the wire compression of pieces on compressible and incompressible data
+#
+#   python benchmark/compression_bench.py --file-size 33554432 --upload-rate 8388608
+#
+# For each kind of data a seeder, rate limited to emulate a network link, serves a file to
+# a leecher with compression off, then a new seeder to a leecher with compression on.
+# Incompressible data should not get slower: its pieces fail the sample test and are
+# sent raw.
+
+from typing import Dict
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from swarm_bench import Swarm, free_port, generate_file, sha256  # noqa: E402
+
+
+def run(data: str, compression: str, args: argparse.Namespace) -> Dict:
+    # Fetch the file once from a fresh seeder, so every run starts with the same rate budget
+    with tempfile.TemporaryDirectory(prefix=f"compression_{data}_") as work_dir:
+        file_name = f"bench-{data}.{'csv' if data == 'text' else 'bin'}"
+        source = os.path.join(work_dir, file_name)
+        generate_file(source, args.file_size, data, 0)
+
+        swarm = Swarm(work_dir, free_port())
+        try:
+            swarm.add_node("seeder", [source], args.upload_rate)
+            swarm.add_node("leecher", extra_args=[f"--compression={compression}"])
+            seconds = swarm.fetch(["leecher"], file_name, args.timeout)["leecher"]
+            complete = sha256(
+                os.path.join(work_dir, "leecher", "repo", file_name)
+            ) == sha256(source)
+        finally:
+            swarm.close()
+    return {
+        "seconds": None if seconds is None else round(seconds, 2),
+        "throughput_mb_s": (
+            round(args.file_size / seconds / 2**20, 2) if seconds else None
+        ),
+        "complete": complete,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="compression_bench",
+        description="Compare fetch throughput with and without wire compression",
+    )
+    parser.add_argument("--file-size", type=int, default=32 * 1024 * 1024)
+    parser.add_argument(
+        "--upload-rate",
+        type=int,
+        default=8 * 1024 * 1024,
+        help="Upload bytes/s of the seeder, the emulated link speed",
+    )
+    parser.add_argument("--compression", default="auto", help="auto, zlib or zstd")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    results = []
+    for data in ("text", "random"):
+        result = {"data": data}
+        for compression in ("off", args.compression):
+            result[compression] = run(data, compression, args)
+        if result["off"]["seconds"] and result[args.compression]["seconds"]:
+            result["speedup"] = round(
+                result["off"]["seconds"] / result[args.compression]["seconds"], 2
+            )
+        results.append(result)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# Benchmark of the hot piece cache under a flash crowd
+#
+#   python benchmark/hot_piece_bench.py --clients 200 --hot-pieces 4 --piece-cache 67108864
+#
+# Many clients connect to a seeder at once and request the same first pieces of a file, as
+# peers do when a new file is published. The seeder runs with the cache off, then with
+# --piece-cache. Per-request latency percentiles, the reads done by the seeder (syscr and
+# rchar of /proc/<pid>/io, socket reads included) and the lookups of its hot cache scraped
+# from its metrics endpoint are reported as JSON.
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+from typing import Dict
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream_memory_bench import find_pieces  # noqa: E402
+from swarm_bench import Process, Swarm, free_port, percentile  # noqa: E402
+from swarm_bench import generate_file  # noqa: E402
+
+
+def read_io(process: Process) -> Dict[str, int]:
+    # Read counters of a process (syscr, rchar, read_bytes)
+    with open(f"/proc/{process.popen.pid}/io") as io_file:
+        counters = dict(line.split(": ") for line in io_file.read().splitlines())
+    return {name: int(counters[name]) for name in ("syscr", "rchar", "read_bytes")}
+
+
+def cache_lookups(metrics_port: int) -> Dict[str, int]:
+    # Hits and misses of the hot cache, from the Prometheus text format
+    url = f"http://127.0.0.1:{metrics_port}/metrics"
+    with urllib.request.urlopen(url, timeout=10) as response:
+        text = response.read().decode()
+    lookups = {"hit": 0, "miss": 0}
+    for line in text.splitlines():
+        if line.startswith('node_cache_lookups_total{cache="hot"'):
+            result = line.split('result="')[1].split('"')[0]
+            lookups[result] = int(float(line.split()[-1]))
+    return lookups
+
+
+def request_piece(address: tuple, piece_hash: str, barrier: Barrier) -> float:
+    # Time to receive a whole piece, measured from a common start of all the clients
+    barrier.wait()
+    start = time.perf_counter()
+    with socket.create_connection(address, timeout=60) as sock:
+        sock.sendall(f"request {piece_hash}\n".encode())
+        buffer = bytearray(65536)
+        while sock.recv_into(buffer):
+            pass
+    return time.perf_counter() - start
+
+
+def run(piece_cache: int, args: argparse.Namespace) -> Dict:
+    with tempfile.TemporaryDirectory(prefix="hot_piece_") as work_dir:
+        file_name = "bench-hot.bin"
+        source = os.path.join(work_dir, file_name)
+        generate_file(source, args.file_size, "random", 0)
+        metrics_port = free_port()
+
+        swarm = Swarm(work_dir, free_port())
+        try:
+            seeder = swarm.add_node(
+                "seeder",
+                [source],
+                extra_args=[
+                    f"--piece-cache={piece_cache}",
+                    f"--metrics-port={metrics_port}",
+                ],
+            )
+            upload_line = next(
+                line for _, line in seeder.lines if "Upload socket address" in line
+            )
+            host, port = upload_line.split()[-1].rsplit(":", 1)
+            address = (host, int(port))
+            hot_hashes = find_pieces(address, file_name)[: args.hot_pieces]
+
+            before = read_io(seeder)
+            latencies = []
+            for _ in range(args.rounds):
+                barrier = Barrier(args.clients)
+                with ThreadPoolExecutor(args.clients) as executor:
+                    latencies.extend(
+                        executor.map(
+                            lambda index: request_piece(
+                                address, hot_hashes[index % len(hot_hashes)], barrier
+                            ),
+                            range(args.clients),
+                        )
+                    )
+            after = read_io(seeder)
+            lookups = cache_lookups(metrics_port)
+        finally:
+            swarm.close()
+
+    return {
+        "requests": len(latencies),
+        "latency_ms": {
+            f"p{q}": round(percentile(latencies, q / 100) * 1000, 1)
+            for q in (50, 90, 99)
+        },
+        "reads": {name: after[name] - before[name] for name in after},
+        "cache_lookups": lookups,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="hot_piece_bench",
+        description="Compare the seeder with and without the hot piece cache under a flash crowd",
+    )
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--hot-pieces", type=int, default=4)
+    parser.add_argument("--file-size", type=int, default=16 * 1024 * 1024)
+    parser.add_argument("--piece-cache", type=int, default=64 * 1024 * 1024)
+    args = parser.parse_args()
+
+    result = {
+        "clients": args.clients,
+        "rounds": args.rounds,
+        "hot_pieces": args.hot_pieces,
+        "no_cache": run(0, args),
+        "cache": run(args.piece_cache, args),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
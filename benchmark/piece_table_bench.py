@@ -0,0 +1,111 @@
+# Benchmark of the memory and lookup time of the node's piece table
+#
+#   python benchmark/piece_table_bench.py --files 1000 --pieces-per-file 1000
+
+from typing import Callable
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "node"))
+
+from node import PIECE_HASH_SIZE, PIECE_SIZE, PieceTable  # noqa: E402
+
+
+class LegacyPiece:
+    # One object per piece, as the node stored them before the piece table (without hashes)
+    def __init__(
+        self, piece_id: int, original_filename: str, start_index: int, end_index: int
+    ):
+        self.piece_id = piece_id
+        self.original_filename = original_filename
+        self.start_index = start_index
+        self.end_index = end_index
+
+
+def build_legacy(files: int, pieces_per_file: int) -> list:
+    pieces = []
+    for file_index in range(files):
+        file_name = f"file_{file_index:06d}.bin"
+        for piece_id in range(pieces_per_file):
+            start_index = piece_id * PIECE_SIZE
+            pieces.append(
+                LegacyPiece(piece_id, file_name, start_index, start_index + PIECE_SIZE)
+            )
+    return pieces
+
+
+def build_table(files: int, pieces_per_file: int) -> PieceTable:
+    table = PieceTable(PIECE_SIZE)
+    for file_index in range(files):
+        table.add_file(
+            f"file_{file_index:06d}.bin",
+            pieces_per_file * PIECE_SIZE,
+            os.urandom(pieces_per_file * PIECE_HASH_SIZE),
+        )
+    return table
+
+
+def measure(build: Callable) -> tuple:
+    # Return the built structure, its traced size in MB and the build time in seconds
+    tracemalloc.start()
+    start = time.perf_counter()
+    structure = build()
+    seconds = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return structure, round(size / 2**20, 1), round(seconds, 2)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="piece_table_bench",
+        description="Compare a list of piece objects with the compact piece table",
+    )
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--pieces-per-file", type=int, default=1000)
+    args = parser.parse_args()
+
+    file_name = f"file_{args.files // 2:06d}.bin"
+    piece_id = args.pieces_per_file - 1
+
+    legacy, legacy_mb, legacy_seconds = measure(
+        lambda: build_legacy(args.files, args.pieces_per_file)
+    )
+    start = time.perf_counter()
+    any(
+        piece.original_filename == file_name and piece.piece_id == piece_id
+        for piece in legacy
+    )
+    legacy_lookup = time.perf_counter() - start
+    del legacy
+
+    table, table_mb, table_seconds = measure(
+        lambda: build_table(args.files, args.pieces_per_file)
+    )
+    start = time.perf_counter()
+    table.has(file_name, piece_id)
+    table_lookup = time.perf_counter() - start
+
+    result = {
+        "pieces": len(table),
+        "list_of_pieces": {
+            "memory_mb": legacy_mb,
+            "build_seconds": legacy_seconds,
+            "lookup_us": round(legacy_lookup * 1e6, 1),
+        },
+        "piece_table": {
+            "memory_mb": table_mb,
+            "build_seconds": table_seconds,
+            "lookup_us": round(table_lookup * 1e6, 1),
+        },
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
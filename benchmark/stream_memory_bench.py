@@ -0,0 +1,226 @@
+# Load test of the memory used by piece transfers
+#
+#   python benchmark/stream_memory_bench.py --connections 100 --buffer-memory 4194304
+#
+# A seeder started with --buffer-memory serves its pieces to many concurrent connections
+# that read slowly, each asking a batch of pieces compressed: the seeder samples every piece
+# through its stream buffers to test whether it is worth compressing (random data is not)
+# and sends it from the disk. Then a leecher fetches the whole file, receiving it through
+# its stream buffers. The RSS of both nodes is sampled from /proc during the load and its
+# growth over the idle RSS is checked against the cap (the stream buffers plus the hot
+# piece cache, off by default, plus a small allowance per connection), the peak of the
+# stream buffers in use is reported from the metrics of the nodes and checked against
+# --buffer-memory. The exit status is 1 when a node grows beyond the cap.
+
+from threading import Event, Thread
+from typing import Callable, Dict, List
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from swarm_bench import Process, Swarm, free_port, generate_file, sha256  # noqa: E402
+
+BATCH_PIECES = 8  # Pieces asked by each slow connection
+# Memory of an upload connection outside the stream buffers (its thread stack, socket file
+# and request line), well under a piece so a connection buffering a whole piece still fails
+CONNECTION_OVERHEAD = 64 * 1024
+
+
+def rss(process: Process) -> int:
+    # Current resident set size in bytes
+    with open(f"/proc/{process.popen.pid}/status") as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def sample_rss(process: Process, stop: Event, samples: List[int]) -> None:
+    while not stop.is_set():
+        try:
+            samples.append(rss(process))
+        except OSError:
+            return
+        time.sleep(0.01)
+
+
+def find_pieces(address: tuple, file_name: str) -> List[str]:
+    # Hashes of the pieces of a file held by a node
+    with socket.create_connection(address, timeout=30) as sock:
+        sock.sendall(f"find {file_name}\n".encode())
+        response = b"".join(iter(lambda: sock.recv(65536), b""))
+    return json.loads(response)[file_name]
+
+
+def stream_buffer_bytes(metrics_port: int) -> int:
+    # Bytes of stream buffers in use, from the Prometheus text format
+    url = f"http://127.0.0.1:{metrics_port}/metrics"
+    with urllib.request.urlopen(url, timeout=10) as response:
+        text = response.read().decode()
+    for line in text.splitlines():
+        if line.startswith("node_stream_buffer_bytes"):
+            return int(float(line.split()[-1]))
+    return 0
+
+
+def sample_buffers(metrics_port: int, stop: Event, samples: List[int]) -> None:
+    while not stop.is_set():
+        try:
+            samples.append(stream_buffer_bytes(metrics_port))
+        except OSError:
+            return
+        time.sleep(0.01)
+
+
+def batch_ids(index: int, piece_count: int) -> str:
+    # Ids of the BATCH_PIECES pieces asked by the connection index, wrapping around the file
+    first = index * BATCH_PIECES % piece_count
+    last = min(first + BATCH_PIECES, piece_count) - 1
+    return f"{first}-{last}"
+
+
+def slow_reader(
+    address: tuple, file_name: str, piece_ids: str, read_delay: float
+) -> int:
+    # Request a batch of pieces compressed and read it in small blocks, keeping the
+    # upload busy
+    with socket.create_connection(address, timeout=30) as sock:
+        sock.sendall(f"request {file_name} {piece_ids} --compress=zlib\n".encode())
+        buffer = bytearray(16 * 1024)
+        received = 0
+        while True:
+            count = sock.recv_into(buffer)
+            if not count:
+                return received
+            received += count
+            time.sleep(read_delay)
+
+
+def measure(process: Process, metrics_port: int, load: Callable[[], None]) -> Dict:
+    idle = rss(process)
+    stop, samples, buffers = Event(), [], []
+    samplers = [
+        Thread(target=sample_rss, args=(process, stop, samples), daemon=True),
+        Thread(target=sample_buffers, args=(metrics_port, stop, buffers), daemon=True),
+    ]
+    for sampler in samplers:
+        sampler.start()
+    start = time.monotonic()
+    load()
+    seconds = time.monotonic() - start
+    stop.set()
+    for sampler in samplers:
+        sampler.join()
+    peak = max(samples, default=idle)
+    return {
+        "seconds": round(seconds, 2),
+        "idle_rss_bytes": idle,
+        "peak_rss_bytes": peak,
+        "rss_growth_bytes": peak - idle,
+        "peak_stream_buffer_bytes": max(buffers, default=0),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="stream_memory_bench",
+        description="Check that the RSS of the nodes stays under the buffer memory cap",
+    )
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--buffer-memory", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--piece-cache", type=int, default=0)
+    parser.add_argument("--file-size", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--upload-rate", type=int, default=None)
+    parser.add_argument("--read-delay", type=float, default=0.001)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="stream_memory_") as work_dir:
+        file_name = "bench-stream.bin"
+        source = os.path.join(work_dir, file_name)
+        generate_file(source, args.file_size, "random", 0)
+        # No compressed piece is kept, so every request samples its pieces again
+        node_args = [
+            f"--buffer-memory={args.buffer_memory}",
+            f"--piece-cache={args.piece_cache}",
+            "--compression-cache=0",
+        ]
+        seeder_metrics, leecher_metrics = free_port(), free_port()
+
+        swarm = Swarm(work_dir, free_port())
+        try:
+            seeder = swarm.add_node(
+                "seeder",
+                [source],
+                args.upload_rate,
+                node_args + [f"--metrics-port={seeder_metrics}"],
+            )
+            upload_line = next(
+                line for _, line in seeder.lines if "Upload socket address" in line
+            )
+            host, port = upload_line.split()[-1].rsplit(":", 1)
+            piece_hashes = find_pieces((host, int(port)), file_name)
+
+            def upload_load() -> None:
+                readers = [
+                    Thread(
+                        target=slow_reader,
+                        args=(
+                            (host, int(port)),
+                            file_name,
+                            batch_ids(index, len(piece_hashes)),
+                            args.read_delay,
+                        ),
+                    )
+                    for index in range(args.connections)
+                ]
+                for reader in readers:
+                    reader.start()
+                for reader in readers:
+                    reader.join()
+
+            upload = measure(seeder, seeder_metrics, upload_load)
+
+            leecher = swarm.add_node(
+                "leecher", extra_args=node_args + [f"--metrics-port={leecher_metrics}"]
+            )
+            download = measure(
+                leecher,
+                leecher_metrics,
+                lambda: swarm.fetch(["leecher"], file_name, args.timeout),
+            )
+            download["complete"] = sha256(
+                os.path.join(work_dir, "leecher", "repo", file_name)
+            ) == sha256(source)
+        finally:
+            swarm.close()
+
+    result = {
+        "connections": args.connections,
+        "buffer_memory": args.buffer_memory,
+        "piece_cache": args.piece_cache,
+        "file_size": args.file_size,
+        "upload_rate": args.upload_rate,
+        "upload": upload,
+        "download": download,
+    }
+    cap = args.buffer_memory + args.piece_cache + args.connections * CONNECTION_OVERHEAD
+    result["rss_cap_bytes"] = cap
+    result["within_cap"] = all(
+        load["rss_growth_bytes"] <= cap
+        and load["peak_stream_buffer_bytes"] <= args.buffer_memory
+        for load in (upload, download)
+    )
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if result["within_cap"] else 1)
+
+
+if __name__ == "__main__":
+    main()
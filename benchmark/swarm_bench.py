@@ -0,0 +1,402 @@
+# Reproducible swarm benchmark: a tracker and N nodes as subprocesses on localhost
+#
+#   python benchmark/swarm_bench.py --nodes 4 --file-size 8388608 --output before.json
+#   python benchmark/swarm_bench.py --nodes 4 --file-size 8388608 --compare before.json
+#
+# Every node runs node.py in its own folder (repo/pieces/temp) and is driven through its
+# command shell. Results (throughput, time-to-complete percentiles of the leechers that got
+# the whole file, failed leechers, CPU and peak RSS of every process) are printed as JSON,
+# so runs of different commits can be compared.
+
+from threading import Thread
+from typing import Dict, List
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NODE_SCRIPT = os.path.join(ROOT, "node", "node.py")
+TRACKER_SCRIPT = os.path.join(ROOT, "tracker", "tracker.py")
+SCENARIOS = ("one_to_n", "n_to_one", "churn", "skewed")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+class Process:
+    """
+    Subprocess of a node or the tracker, driven through its command shell
+
+    Every output line is kept with its arrival time, so the harness can wait for
+    the messages printed by the shell (e.g "Combined pieces ok").
+    """
+
+    def __init__(self, name: str, args: List[str], cwd: str) -> None:
+        self.name = name
+        self.popen = subprocess.Popen(
+            [sys.executable, "-u"] + args,
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        self.lines: List[tuple] = []
+        self.reader = Thread(target=self.read_output, daemon=True)
+        self.reader.start()
+
+    def read_output(self) -> None:
+        for line in self.popen.stdout:
+            self.lines.append((time.monotonic(), line.rstrip("\n")))
+
+    def send(self, command: str) -> None:
+        self.popen.stdin.write(command + "\n")
+        self.popen.stdin.flush()
+
+    def wait_for(self, text: str, timeout: float, after: float = 0) -> float | None:
+        # Return the time the first line containing text was printed after the given time
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for line_time, line in list(self.lines):
+                if line_time >= after and text in line:
+                    return line_time
+            if self.popen.poll() is not None:
+                return None
+            time.sleep(0.01)
+        return None
+
+    def usage(self) -> Dict:
+        # CPU seconds and peak RSS of the process, read from /proc while it is alive
+        try:
+            with open(f"/proc/{self.popen.pid}/stat") as stat_file:
+                fields = stat_file.read().rsplit(")", 1)[1].split()
+            cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            peak_rss = None
+            with open(f"/proc/{self.popen.pid}/status") as status_file:
+                for line in status_file:
+                    if line.startswith("VmHWM:"):
+                        peak_rss = int(line.split()[1]) * 1024
+            return {"cpu_seconds": round(cpu, 2), "peak_rss_bytes": peak_rss}
+        except (OSError, IndexError, ValueError):
+            return {"cpu_seconds": None, "peak_rss_bytes": None}
+
+    def kill(self) -> None:
+        if self.popen.poll() is None:
+            self.popen.send_signal(signal.SIGKILL)
+        self.popen.wait()
+
+
+class Swarm:
+    """
+    A tracker and its nodes, each one running in its own folder under work_dir
+
+    Args:
+        - work_dir (str): Folder holding the tracker folder and one folder per node
+        - tracker_port (int): Port of the tracker on localhost
+    """
+
+    def __init__(self, work_dir: str, tracker_port: int) -> None:
+        self.work_dir = work_dir
+        self.tracker_port = tracker_port
+        self.nodes: Dict[str, Process] = {}
+        tracker_dir = os.path.join(work_dir, "tracker")
+        os.makedirs(tracker_dir)
+        self.tracker = Process(
+            "tracker",
+            [TRACKER_SCRIPT, "--host=127.0.0.1", f"--port={tracker_port}"],
+            tracker_dir,
+        )
+        if self.tracker.wait_for("Tracker is running", timeout=10) is None:
+            raise RuntimeError("Tracker did not start")
+
+    def add_node(
+        self,
+        name: str,
+        files: List[str] = (),
+        upload_rate: int = None,
+        extra_args: List[str] = (),
+    ) -> Process:
+        node_dir = os.path.join(self.work_dir, name)
+        os.makedirs(os.path.join(node_dir, "repo"))
+        for file_path in files:
+            shutil.copy(file_path, os.path.join(node_dir, "repo"))
+        args = [
+            NODE_SCRIPT,
+            "--host=127.0.0.1",
+            f"--port={self.tracker_port}",
+            "--upload-ip=127.0.0.1",
+        ]
+        if upload_rate:
+            args.append(f"--upload-rate={upload_rate}")
+        args.extend(extra_args)
+        node = Process(name, args, node_dir)
+        if node.wait_for("Upload socket address", timeout=30) is None:
+            raise RuntimeError(f"Node {name} did not start")
+        self.nodes[name] = node
+        return node
+
+    def fetch(
+        self, leechers: List[str], file_name: str, timeout: float
+    ) -> Dict[str, float | None]:
+        # Start the fetch on every leecher at once and return each time to complete
+        start = time.monotonic()
+        for name in leechers:
+            self.nodes[name].send(f"fetch {file_name}")
+        durations = {}
+        for name in leechers:
+            done = self.nodes[name].wait_for(
+                "Combined pieces ok",
+                timeout=max(0.0, start + timeout - time.monotonic()),
+                after=start,
+            )
+            durations[name] = None if done is None else done - start
+        return durations
+
+    def usage(self) -> Dict[str, Dict]:
+        usage = {name: node.usage() for name, node in self.nodes.items()}
+        usage["tracker"] = self.tracker.usage()
+        return usage
+
+    def close(self) -> None:
+        for node in self.nodes.values():
+            node.kill()
+        self.tracker.kill()
+
+
+def generate_file(path: str, size: int, data: str, seed: int) -> None:
+    # Random (incompressible) or text-like (compressible) synthetic data
+    rng = random.Random(seed)
+    words = [
+        "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(8))
+        for _ in range(512)
+    ]
+    with open(path, "wb") as file:
+        written = 0
+        while written < size:
+            if data == "random":
+                block = rng.randbytes(min(1024 * 1024, size - written))
+            else:
+                block = (
+                    ",".join(rng.choice(words) for _ in range(20000)).encode() + b"\n"
+                )[: size - written]
+            file.write(block)
+            written += len(block)
+
+
+def sha256(path: str) -> str | None:
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def percentile(values: List[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return round(values[index], 3)
+
+
+def run_scenario(scenario: str, args: argparse.Namespace, port: int) -> Dict:
+    with tempfile.TemporaryDirectory(prefix=f"swarm_{scenario}_") as work_dir:
+        extension = "bin" if args.data == "random" else "csv"
+        file_name = f"bench-{scenario.replace('_', '-')}.{extension}"
+        source = os.path.join(work_dir, file_name)
+        generate_file(source, args.file_size, args.data, args.seed)
+        expected = sha256(source)
+
+        swarm = Swarm(work_dir, port)
+        try:
+            if scenario == "one_to_n":
+                # One seeder, every other node fetches at once
+                swarm.add_node("seeder_0", [source])
+                leechers = [f"leecher_{i}" for i in range(args.nodes)]
+            elif scenario == "n_to_one":
+                # Every seeder holds the file, a single node fetches it
+                for i in range(args.nodes):
+                    swarm.add_node(f"seeder_{i}", [source])
+                leechers = ["leecher_0"]
+            elif scenario == "churn":
+                # Seeders leave during the transfer, rate limited so they leave mid-way
+                for i in range(args.nodes):
+                    swarm.add_node(f"seeder_{i}", [source], args.slow_rate)
+                leechers = [f"leecher_{i}" for i in range(max(1, args.nodes // 2))]
+            else:
+                # One fast seeder, the others upload at slow_rate
+                swarm.add_node("seeder_0", [source])
+                for i in range(1, args.nodes):
+                    swarm.add_node(f"seeder_{i}", [source], args.slow_rate)
+                leechers = ["leecher_0"]
+            for name in leechers:
+                swarm.add_node(name)
+
+            start = time.monotonic()
+            if scenario == "churn":
+                seeders = [name for name in swarm.nodes if name.startswith("seeder")]
+                killer = Thread(
+                    target=lambda: (
+                        time.sleep(args.churn_delay),
+                        [swarm.nodes[name].kill() for name in seeders[::2]],
+                    ),
+                    daemon=True,
+                )
+                for name in leechers:
+                    swarm.nodes[name].send(f"fetch {file_name}")
+                killer.start()
+                durations = {}
+                for name in leechers:
+                    done = swarm.nodes[name].wait_for(
+                        "Combined pieces ok",
+                        timeout=max(0.0, start + args.timeout - time.monotonic()),
+                        after=start,
+                    )
+                    durations[name] = None if done is None else done - start
+                killer.join()
+            else:
+                durations = swarm.fetch(leechers, file_name, args.timeout)
+            wall_time = time.monotonic() - start
+
+            # Give the pieces generation after combining a moment before measuring
+            time.sleep(0.2)
+            usage = swarm.usage()
+            complete = [
+                name
+                for name in leechers
+                if sha256(os.path.join(work_dir, name, "repo", file_name)) == expected
+            ]
+        finally:
+            swarm.close()
+
+    # A leecher whose fetch failed may have printed the message, only the leechers that
+    # hold the whole file are timed, the others are reported as failed
+    times = [durations[name] for name in complete if durations[name] is not None]
+    return {
+        "scenario": scenario,
+        "nodes": len(usage) - 1,
+        "leechers": len(leechers),
+        "file_size": args.file_size,
+        "complete": len(complete),
+        "failed": len(leechers) - len(complete),
+        "wall_seconds": round(wall_time, 3),
+        "throughput_mb_s": round(
+            len(complete) * args.file_size / wall_time / 1024 / 1024, 2
+        ),
+        "time_to_complete": {
+            "p50": percentile(times, 0.5),
+            "p90": percentile(times, 0.9),
+            "p99": percentile(times, 0.99),
+            "max": round(max(times), 3) if times else None,
+        },
+        "cpu_seconds_total": round(
+            sum(item["cpu_seconds"] or 0 for item in usage.values()), 2
+        ),
+        "peak_rss_bytes_max": max(
+            (item["peak_rss_bytes"] or 0 for item in usage.values()), default=0
+        ),
+        "processes": usage,
+    }
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous: Dict, current: Dict) -> Dict:
+    # Ratio current / previous of the main figures of each scenario
+    previous_results = {result["scenario"]: result for result in previous["results"]}
+    comparison = {}
+    for result in current["results"]:
+        old = previous_results.get(result["scenario"])
+        if old is None:
+            continue
+        ratios = {}
+        for key, old_value, new_value in (
+            ("throughput", old["throughput_mb_s"], result["throughput_mb_s"]),
+            ("p50", old["time_to_complete"]["p50"], result["time_to_complete"]["p50"]),
+            ("cpu", old["cpu_seconds_total"], result["cpu_seconds_total"]),
+            ("peak_rss", old["peak_rss_bytes_max"], result["peak_rss_bytes_max"]),
+        ):
+            ratios[key] = (
+                round(new_value / old_value, 3) if old_value and new_value else None
+            )
+        comparison[result["scenario"]] = ratios
+    return comparison
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="swarm_bench",
+        description="Run fetch scenarios on a local swarm and report JSON results",
+    )
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--nodes", type=int, default=4, help="Seeders or leechers")
+    parser.add_argument("--file-size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--data", choices=("random", "text"), default="random")
+    parser.add_argument(
+        "--slow-rate",
+        type=int,
+        default=1024 * 1024,
+        help="Upload bytes/s of the slow seeders (skewed, churn)",
+    )
+    parser.add_argument(
+        "--churn-delay",
+        type=float,
+        default=1.0,
+        help="Seconds before half of the seeders are killed (churn)",
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Also write the JSON here")
+    parser.add_argument("--compare", default=None, help="JSON of a previous run")
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare")
+        },
+        "results": [
+            run_scenario(scenario, args, free_port()) for scenario in args.scenarios
+        ],
+    }
+    if args.compare:
+        with open(args.compare) as previous_file:
+            report["compare"] = compare(json.load(previous_file), report)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
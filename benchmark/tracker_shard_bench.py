@@ -0,0 +1,198 @@
+# Benchmark of the announce/fetch throughput of a tracker cluster against its shard count
+#
+#   python benchmark/tracker_shard_bench.py --shards 1 2 4 --clients 8 --duration 5
+#
+# Every shard is a tracker.py subprocess listening on localhost, every client is a process
+# routing its requests with the same consistent hash ring as node.py.
+
+from multiprocessing import Process, Queue
+from typing import Dict, List
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "node"))
+
+from node import HashRing, NodeUtils, TrackerConnection  # noqa: E402
+
+
+def start_trackers(shard_count: int, base_port: int, work_dir: str) -> List:
+    trackers = []
+    for index in range(shard_count):
+        tracker_dir = os.path.join(work_dir, f"tracker_{index}")
+        os.makedirs(tracker_dir)
+        trackers.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.join(ROOT, "tracker", "tracker.py"),
+                    "--host=127.0.0.1",
+                    f"--port={base_port + index}",
+                ],
+                cwd=tracker_dir,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        )
+    for index in range(shard_count):
+        wait_for_port(base_port + index)
+    return trackers
+
+
+def wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Tracker on port {port} did not start")
+
+
+def client(
+    client_id: int,
+    shards: List[str],
+    files_per_client: int,
+    total_files: int,
+    duration: float,
+    results: Queue,
+) -> None:
+    ring = HashRing(shards)
+    trackers: Dict[str, TrackerConnection] = {}
+    file_info = {
+        f"file_{client_id}_{index}.bin": {
+            "file_size": 1024 * 1024,
+            "piece_size": 512 * 1024,
+            "piece_count": 2,
+        }
+        for index in range(files_per_client)
+    }
+
+    def shard_info(shard: str) -> str:
+        return json.dumps(
+            {
+                name: info
+                for name, info in file_info.items()
+                if ring.lookup(name)[0] == shard
+            }
+        )
+
+    for shard in shards:
+        ip, port = shard.rsplit(":", 1)
+        tracker = TrackerConnection(ip, int(port))
+        tracker.connect()
+        NodeUtils.send_line(tracker.sock, "First Connection")
+        NodeUtils.send_line(
+            tracker.sock,
+            f"127.0.0.{client_id + 1} {tracker.sock.getsockname()[1]} {10000 + client_id} {shard_info(shard)}",
+        )
+        NodeUtils.recv_line(tracker.reader)
+        trackers[shard] = tracker
+
+    rng = random.Random(client_id)
+    client_count = max(1, total_files // files_per_client)
+    announces = fetches = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        # Re-announce to one shard, as a node does after each download
+        shard = shards[announces % len(shards)]
+        trackers[shard].request(f"publish {shard_info(shard)}")
+        announces += 1
+
+        file_name = (
+            f"file_{rng.randrange(client_count)}_{rng.randrange(files_per_client)}.bin"
+        )
+        trackers[ring.lookup(file_name)[0]].request(f"fetch {file_name}")
+        fetches += 1
+
+    for tracker in trackers.values():
+        tracker.send("close")
+        tracker.close()
+    results.put((announces, fetches))
+
+
+def run(
+    shard_count: int,
+    clients: int,
+    files_per_client: int,
+    duration: float,
+    base_port: int,
+) -> Dict:
+    with tempfile.TemporaryDirectory() as work_dir:
+        trackers = start_trackers(shard_count, base_port, work_dir)
+        shards = [f"127.0.0.1:{base_port + index}" for index in range(shard_count)]
+        results: Queue = Queue()
+        processes = [
+            Process(
+                target=client,
+                args=(
+                    client_id,
+                    shards,
+                    files_per_client,
+                    clients * files_per_client,
+                    duration,
+                    results,
+                ),
+            )
+            for client_id in range(clients)
+        ]
+        for process in processes:
+            process.start()
+        totals = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        for tracker in trackers:
+            tracker.kill()
+            tracker.wait()
+
+    announces = sum(announce for announce, _ in totals)
+    fetches = sum(fetch for _, fetch in totals)
+    return {
+        "shards": shard_count,
+        "clients": clients,
+        "catalog_size": clients * files_per_client,
+        "duration": duration,
+        "announce_per_sec": round(announces / duration, 1),
+        "fetch_per_sec": round(fetches / duration, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="tracker_shard_bench",
+        description="Measure tracker announce/fetch throughput against the shard count",
+    )
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--files-per-client", type=int, default=250)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--base-port", type=int, default=9100)
+    args = parser.parse_args()
+
+    results = []
+    for shard_count in args.shards:
+        results.append(
+            run(
+                shard_count,
+                args.clients,
+                args.files_per_client,
+                args.duration,
+                args.base_port,
+            )
+        )
+        # Use fresh ports so a lingering socket of the previous run does not interfere
+        args.base_port += shard_count
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+# Author: Cao Ngoc Lam, Nguyen Chau Hoang Long
+# Lightweight metrics shared by the node and the tracker
+
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Tuple
+import bisect
+import time
+
+# Upper bounds (seconds) of the buckets of latency histograms
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class Metric(ABC):
+    """
+    Base class of a metric made of one value per combination of label values
+
+    Args:
+        - name (str): Metric name in the Prometheus text format
+        - help (str): Description of the metric
+        - labelnames (Tuple[str, ...]): Names of the labels, values are given as a tuple in the same order
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.lock = Lock()
+
+    def format_labels(self, labels: Tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @abstractmethod
+    def samples(self) -> List[Tuple[str, float]]:
+        # (sample name with its labels, value) of every value of the metric
+        ...
+
+
+class Counter(Metric):
+    # Monotonically increasing value, e.g bytes sent or requests handled
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, labels: Tuple = ()) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels: Tuple = ()) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self) -> List[Tuple[str, float]]:
+        with self.lock:
+            items = list(self.values.items())
+        return [
+            (self.name + self.format_labels(labels), value) for labels, value in items
+        ]
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, e.g active upload threads
+
+    If a callback is given, the value is read from it when the metrics are rendered,
+    so the hot path does not pay anything for it.
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        callback: Callable[[], float] = None,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, labels: Tuple = ()) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, amount: float = 1, labels: Tuple = ()) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: Tuple = ()) -> None:
+        self.inc(-amount, labels)
+
+    def get(self, labels: Tuple = ()) -> float:
+        if self.callback is not None:
+            return self.callback()
+        return self.values.get(labels, 0)
+
+    def samples(self) -> List[Tuple[str, float]]:
+        if self.callback is not None:
+            return [(self.name, self.callback())]
+        with self.lock:
+            items = list(self.values.items())
+        return [
+            (self.name + self.format_labels(labels), value) for labels, value in items
+        ]
+
+
+class Histogram(Metric):
+    # Distribution of observed values (e.g latencies) counted in fixed buckets
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count of each bucket (+Inf last), sum, count]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, labels: Tuple = ()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None:
+                data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def time(self, labels: Tuple = ()) -> "Timer":
+        # Context manager observing the duration of its block
+        return Timer(self, labels)
+
+    def quantile(self, q: float, labels: Tuple = ()) -> float:
+        # Upper bound of the bucket holding the q-quantile (inf if it is in the last bucket)
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None or data[2] == 0:
+                return 0.0
+            counts, count = list(data[0]), data[2]
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self) -> List[Tuple[str, float]]:
+        with self.lock:
+            items = [
+                (labels, (list(data[0]), data[1], data[2]))
+                for labels, data in self.values.items()
+            ]
+        result = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound}"
+                result.append(
+                    (
+                        f"{self.name}_bucket"
+                        + self.format_labels(labels, f'le="{le}"'),
+                        cumulative,
+                    )
+                )
+            result.append((f"{self.name}_sum" + self.format_labels(labels), total))
+            result.append((f"{self.name}_count" + self.format_labels(labels), count))
+        return result
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: Tuple) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class MetricsRegistry:
+    """
+    Set of the metrics of a node or a tracker
+
+    Updating a metric is a dictionary update under a per-metric lock, so the metrics
+    can stay enabled on the hot paths.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+        self.start_time = time.monotonic()
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, help: str, labelnames: Tuple[str, ...] = ()
+    ) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        callback: Callable[[], float] = None,
+    ) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, callback))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render_prometheus(self) -> str:
+        # Render every metric in the Prometheus text exposition format
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for sample_name, value in metric.samples():
+                lines.append(f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        # Human readable summary for the stats shell command
+        uptime = time.monotonic() - self.start_time
+        lines = [f"uptime: {uptime:.1f}s"]
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                with metric.lock:
+                    label_sets = list(metric.values.keys())
+                for labels in label_sets:
+                    _, total, count = metric.values[labels]
+                    lines.append(
+                        f"{metric.name}{metric.format_labels(labels)}: count={count} "
+                        f"mean={total / count * 1000:.2f}ms "
+                        f"p50<={metric.quantile(0.5, labels) * 1000:g}ms "
+                        f"p99<={metric.quantile(0.99, labels) * 1000:g}ms"
+                    )
+            elif isinstance(metric, Counter):
+                for sample_name, value in metric.samples():
+                    lines.append(f"{sample_name}: {value:.0f} ({value / uptime:.1f}/s)")
+            else:
+                for sample_name, value in metric.samples():
+                    lines.append(f"{sample_name}: {value:g}")
+        return "\n".join(lines)
+
+
+class MetricsServer:
+    """
+    Serve the metrics of a registry in the Prometheus text format on http://host:port/metrics
+
+    Args:
+        - registry (MetricsRegistry): Metrics to expose
+        - host (str): Address to bind, local only by default
+        - port (int): Port to bind
+    """
+
+    def __init__(
+        self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9000
+    ) -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                # Keep the command shell output clean
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def close(self) -> None:
+        # shutdown waits for serve_forever, which only runs once the server is started
+        if self.thread.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
@@ -1,46 +1,723 @@
 # Author: Cao Ngoc Lam, Nguyen Chau Hoang Long
 # Date modified: Thursday 22st Nov 2024
 
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Iterator, Callable
+from array import array
 import traceback
-from threading import Thread
+from threading import Thread, Lock, Condition, Event
+from contextlib import contextmanager
 import socket
 import os
-import mmap
 import json
 import time
 import math
+import bisect
+import hashlib
+import random
+import sys
 import argparse
+import itertools
+import shutil
+import tempfile
+import zlib
+import mmap
+from collections import OrderedDict
+from queue import Queue
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.metrics import Counter, MetricsRegistry, MetricsServer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 REPO_FOLDER = "repo"
 PIECES_FOLDER = "pieces"
 TEMP_FOLDER = "temp"
 PIECE_SIZE = 512 * 1024
 REQUEST_TIMEOUT = 2
+PEERS_PAGE_SIZE = 20  # Number of peers per file asked from the tracker in one page
+HEARTBEAT_INTERVAL = 10  # Seconds between two heartbeats (tracker TTL is 30s)
+VIRTUAL_NODES = 64  # Points of each tracker shard on the consistent hash ring
+PEX_INTERVAL = 15  # Seconds between two peer exchange rounds
+PEX_FANOUT = 3  # Number of known peers gossiped with in each round
+PEX_MAX_ENTRIES = 50  # Maximum number of known peers sent in a peer exchange message
+MAX_KNOWN_PEERS = 500  # Maximum number of peers remembered through peer exchange
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Bytes sent at once when the upload rate is limited
+SEARCH_PAGE_SIZE = 100  # Number of file names asked in one discover/search page
+STREAM_BUFFER_SIZE = (
+    64 * 1024
+)  # Size of the reusable buffers that file data streams through
+BUFFER_MEMORY = 16 * 1024 * 1024  # Default cap of the memory held by the stream buffers
+PIECE_HASH_SIZE = 32  # Bytes of the sha256 digest that names a piece
+# Wire compression codecs this node can use, in order of preference
+CODECS = ("zstd", "zlib") if zstandard is not None else ("zlib",)
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESSION_CACHE = 32 * 1024 * 1024  # Default size of the cache of compressed pieces
+PIECE_CACHE = 64 * 1024 * 1024  # Default size of the in-memory cache of hot pieces
+BATCH_PIECES = 64  # Maximum number of pieces asked in one batched request
+BATCH_SEND_SIZE = (
+    1024 * 1024
+)  # Bytes of in-memory pieces gathered into one vectored write
+SENDMSG_MAX_BUFFERS = 64  # Maximum number of buffers given to one sendmsg call
+WATCH_INTERVAL = 1  # Seconds between two progress lines of the watch command
+FINISHED_FETCHES_KEPT = 16  # Finished fetches still listed by the jobs command
+COMPRESSION_SAMPLE_SIZE = (
+    64 * 1024
+)  # Bytes of a piece compressed to test if it is worth it
+MAX_COMPRESSION_RATIO = (
+    0.9  # Pieces whose sample compresses worse than this are sent raw
+)
+# The sample is compressed with a small window and little memory, a few KiB per upload
+# instead of the hundreds of KiB of a default zlib stream
+SAMPLE_WINDOW_BITS = 10
+SAMPLE_MEM_LEVEL = 2
+SAMPLE_CHUNK_SIZE = 4096  # Bytes of the sample compressed at a time
+# Files whose data is already compressed, compression is never asked for their pieces
+COMPRESSED_EXTENSIONS = (
+    ".pdf",
+    ".mp4",
+    ".mkv",
+    ".webm",
+    ".mp3",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".zip",
+    ".gz",
+    ".tgz",
+    ".bz2",
+    ".xz",
+    ".zst",
+    ".7z",
+    ".rar",
+    ".docx",
+    ".xlsx",
+    ".pptx",
+)
 
 
 class Piece:
     """
     Represent an mapping info to real pieces in PIECES_FOLDER
 
+    Pieces are stored in a PieceTable, a Piece is a lightweight view created on lookup
+
     Args:
         - piece_id (int): Piece ID
         - original_filename (str): Original filename that the pieces belong to
         - start_index (int): Start index of the piece in byte array representation of file
         - end_index (int): End index of the piece in byte array representation of file
+        - piece_hash (str): sha256 of the piece content, the name of the piece in PIECES_FOLDER
     """
 
+    __slots__ = (
+        "piece_id",
+        "original_filename",
+        "start_index",
+        "end_index",
+        "piece_hash",
+    )
+
     def __init__(
-        self, piece_id: int, original_filename: str, start_index: int, end_index: int
+        self,
+        piece_id: int,
+        original_filename: str,
+        start_index: int,
+        end_index: int,
+        piece_hash: str = None,
     ):
         self.piece_id = piece_id
         self.original_filename = original_filename
         self.start_index = start_index
         self.end_index = end_index
+        self.piece_hash = piece_hash
 
     def __repr__(self):
-        return f"Piece({self.piece_id}, Original file: {self.original_filename}, {self.start_index} - {self.end_index})"
+        return f"Piece({self.piece_id}, Original file: {self.original_filename}, {self.start_index} - {self.end_index}, {(self.piece_hash or '')[:12]})"
+
+
+class PieceTable:
+    """
+    Compact table of the pieces that the node has
+
+    A node only holds complete files, so the pieces of a file are always 0 .. piece_count - 1
+    and their offsets derive from the piece size. The table stores one (file id, piece count,
+    file size) entry per file instead of one object per piece, with O(1) lookup by (file, piece).
+    The sha256 of the pieces of a file are kept as one bytes object of concatenated digests.
+
+    Args:
+        - piece_size (int): Size of every piece but the last one of a file
+    """
+
+    def __init__(self, piece_size: int = PIECE_SIZE) -> None:
+        self.piece_size = piece_size
+        self.file_ids: Dict[str, int] = {}
+        self.file_names: List[str] = []
+        self.piece_counts = array("Q")
+        self.file_sizes = array("Q")
+        self.piece_hashes: List[bytes] = []
+        self.total_pieces = 0
+
+    def add_file(self, file_name: str, file_size: int, piece_hashes: bytes) -> int:
+        # Register (or update) a file with the concatenated digests of its pieces and return its id
+        piece_count = math.ceil(file_size / self.piece_size)
+        if len(piece_hashes) != piece_count * PIECE_HASH_SIZE:
+            raise ValueError(f"{file_name} has {piece_count} pieces")
+        file_id = self.file_ids.get(file_name)
+        if file_id is None:
+            file_id = len(self.file_names)
+            self.file_names.append(file_name)
+            self.piece_counts.append(piece_count)
+            self.file_sizes.append(file_size)
+            self.piece_hashes.append(piece_hashes)
+            self.file_ids[file_name] = file_id
+        else:
+            self.total_pieces -= self.piece_counts[file_id]
+            self.piece_counts[file_id] = piece_count
+            self.file_sizes[file_id] = file_size
+            self.piece_hashes[file_id] = piece_hashes
+        self.total_pieces += piece_count
+        return file_id
+
+    def __contains__(self, file_name: str) -> bool:
+        return file_name in self.file_ids
+
+    def __len__(self) -> int:
+        return self.total_pieces
+
+    def piece_count(self, file_name: str) -> int:
+        file_id = self.file_ids.get(file_name)
+        return 0 if file_id is None else self.piece_counts[file_id]
+
+    def has(self, file_name: str, piece_id: int) -> bool:
+        return 0 <= piece_id < self.piece_count(file_name)
+
+    def piece_hash(self, file_name: str, piece_id: int) -> str:
+        if not self.has(file_name, piece_id):
+            raise KeyError((file_name, piece_id))
+        digests = self.piece_hashes[self.file_ids[file_name]]
+        start = piece_id * PIECE_HASH_SIZE
+        return digests[start : start + PIECE_HASH_SIZE].hex()
+
+    def hashes_of(self, file_name: str) -> List[str]:
+        # Hashes of the pieces of a file, in piece order
+        file_id = self.file_ids.get(file_name)
+        if file_id is None:
+            return []
+        digests = self.piece_hashes[file_id]
+        return [
+            digests[start : start + PIECE_HASH_SIZE].hex()
+            for start in range(0, len(digests), PIECE_HASH_SIZE)
+        ]
+
+    def version(self, file_name: str) -> str:
+        # Version id of a file: the sha256 of the concatenated hashes of its pieces
+        return hashlib.sha256(self.piece_hashes[self.file_ids[file_name]]).hexdigest()
+
+    def referenced(self, piece_hashes: set) -> set:
+        # Subset of piece_hashes that are pieces of a file of the table
+        digests = {bytes.fromhex(piece_hash) for piece_hash in piece_hashes}
+        found = set()
+        for file_digests in self.piece_hashes:
+            for start in range(0, len(file_digests), PIECE_HASH_SIZE):
+                digest = file_digests[start : start + PIECE_HASH_SIZE]
+                if digest in digests:
+                    found.add(digest.hex())
+        return found
+
+    def get(self, file_name: str, piece_id: int) -> Piece:
+        start_index = piece_id * self.piece_size
+        return Piece(
+            piece_id,
+            file_name,
+            start_index,
+            start_index + self.piece_size,
+            self.piece_hash(file_name, piece_id),
+        )
+
+    def pieces_of(self, file_name: str) -> Iterator[Piece]:
+        for piece_id in range(self.piece_count(file_name)):
+            yield self.get(file_name, piece_id)
+
+    def __iter__(self) -> Iterator[Piece]:
+        for file_name in self.file_names:
+            yield from self.pieces_of(file_name)
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the bytes per second shared by all the upload threads of a node
+
+    Args:
+        - rate (int): Allowed bytes per second
+    """
+
+    def __init__(self, rate: int) -> None:
+        self.rate = rate
+        self.allowance = 0.0
+        self.last_time = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, amount: int) -> None:
+        # Block until amount bytes may be sent
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(
+                self.rate, self.allowance + (now - self.last_time) * self.rate
+            )
+            self.last_time = now
+            self.allowance -= amount
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class BufferPool:
+    """
+    Fixed-size reusable buffers that every piece transfer streams through
+
+    At most capacity // buffer_size buffers are ever allocated, a transfer waits for a free
+    buffer when all of them are in use, so the memory held by file data stays under capacity
+    whatever the piece size and the number of connections.
+
+    Args:
+        - capacity (int): Maximum bytes held by the buffers
+        - buffer_size (int): Size of each buffer
+    """
+
+    def __init__(self, capacity: int, buffer_size: int = STREAM_BUFFER_SIZE) -> None:
+        self.buffer_size = buffer_size
+        self.max_buffers = max(1, capacity // buffer_size)
+        self.free: List[bytearray] = []
+        self.allocated = 0
+        self.condition = Condition()
+
+    def acquire(self) -> bytearray:
+        with self.condition:
+            while not self.free and self.allocated >= self.max_buffers:
+                self.condition.wait()
+            if self.free:
+                return self.free.pop()
+            self.allocated += 1
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray) -> None:
+        with self.condition:
+            self.free.append(buffer)
+            self.condition.notify()
+
+    @contextmanager
+    def buffer(self) -> Iterator[memoryview]:
+        buffer = self.acquire()
+        try:
+            with memoryview(buffer) as view:
+                yield view
+        finally:
+            self.release(buffer)
+
+    def in_use(self) -> int:
+        # Bytes of the buffers currently borrowed
+        with self.condition:
+            return (self.allocated - len(self.free)) * self.buffer_size
+
+
+class ByteLRU:
+    """
+    Least recently used cache of bytes values, bounded by the total size of the values
+
+    Every entry is charged ENTRY_OVERHEAD bytes on top of its value, so empty values (e.g a
+    piece known to be incompressible) cannot grow the cache without bound. Values loaded by
+    get_or_load are charged before they are loaded, and only once their key missed twice, so
+    values asked for once (e.g every piece of a file streamed to one peer) are never read into
+    memory and never evict the others. A value returned by get_or_load is not evicted before
+    release is called for it, so values still in use are never held outside the capacity.
+
+    Args:
+        - capacity (int): Maximum total bytes of the cached values
+        - lookups (Counter): Optional counter of the lookups, labelled (name, "hit" | "miss")
+        - name (str): Name of the cache in the lookups counter
+    """
+
+    ENTRY_OVERHEAD = 256
+    MAX_MISSED_KEYS = 4096
+
+    def __init__(self, capacity: int, lookups: Counter = None, name: str = "") -> None:
+        self.capacity = capacity
+        self.size = 0
+        self.items: OrderedDict = OrderedDict()
+        self.lock = Lock()
+        self.lookups = lookups
+        self.name = name
+        # Keys being loaded by get_or_load
+        self.loading = set()
+        # Keys that missed once in get_or_load, most recent last
+        self.missed: OrderedDict = OrderedDict()
+        # Number of users of each value returned by get_or_load and not released yet
+        self.users: Dict = {}
+        # Notified when a key leaves loading
+        self.loaded = Condition(self.lock)
+
+    def get(self, key) -> bytes | None:
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+        if self.lookups is not None:
+            self.lookups.inc(1, (self.name, "miss" if value is None else "hit"))
+        return value
+
+    def get_or_load(self, key, load: Callable[[], bytes], size: int) -> bytes | None:
+        # Cached value of key, or the value of size bytes returned by load which is then cached
+        # None on the first miss of the key, if another thread is already loading the key (so
+        # a value is loaded only once) or if the value does not fit in the cache
+        # A returned value is in use until release(key) is called
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+                self.users[key] = self.users.get(key, 0) + 1
+        if self.lookups is not None:
+            self.lookups.inc(1, (self.name, "miss" if value is None else "hit"))
+        if value is not None:
+            return value
+        with self.lock:
+            if key in self.loading:
+                return None
+            if key not in self.missed:
+                self.missed[key] = None
+                if len(self.missed) > self.MAX_MISSED_KEYS:
+                    self.missed.popitem(last=False)
+                return None
+            del self.missed[key]
+            if not self.evict(size + self.ENTRY_OVERHEAD):
+                return None
+            # The value is charged while it is loaded
+            self.size += size + self.ENTRY_OVERHEAD
+            self.loading.add(key)
+        try:
+            value = load()
+        finally:
+            with self.lock:
+                self.size -= size + self.ENTRY_OVERHEAD
+                self.loading.discard(key)
+                self.loaded.notify_all()
+        with self.lock:
+            if not self.evict(len(value) + self.ENTRY_OVERHEAD):
+                return None
+            self.items[key] = value
+            self.size += len(value) + self.ENTRY_OVERHEAD
+            self.users[key] = self.users.get(key, 0) + 1
+        return value
+
+    def get_or_wait(self, key, load: Callable[[], bytes]) -> bytes:
+        # Cached value of key, or the value returned by load which is then cached
+        # Threads asking for a key being loaded wait for it, so a value is loaded only once
+        with self.lock:
+            while True:
+                value = self.items.get(key)
+                if value is not None:
+                    self.items.move_to_end(key)
+                    break
+                if key not in self.loading:
+                    self.loading.add(key)
+                    break
+                self.loaded.wait()
+        if self.lookups is not None:
+            self.lookups.inc(1, (self.name, "miss" if value is None else "hit"))
+        if value is not None:
+            return value
+        try:
+            value = load()
+            self.put(key, value)
+        finally:
+            with self.lock:
+                self.loading.discard(key)
+                self.loaded.notify_all()
+        return value
+
+    def release(self, key) -> None:
+        # The value of key returned by get_or_load is no longer used
+        with self.lock:
+            self.users[key] -= 1
+            if not self.users[key]:
+                del self.users[key]
+
+    def put(self, key, value: bytes) -> None:
+        with self.lock:
+            if key in self.users:
+                return
+            old_value = self.items.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value) + self.ENTRY_OVERHEAD
+            if self.evict(len(value) + self.ENTRY_OVERHEAD):
+                self.items[key] = value
+                self.size += len(value) + self.ENTRY_OVERHEAD
+
+    def evict(self, size: int) -> bool:
+        # Drop the least recently used values not in use until size more bytes fit in the
+        # cache, with the lock held. False (and nothing dropped) if they cannot fit
+        freed = 0
+        evicted = []
+        for key, value in self.items.items():
+            if self.size - freed + size <= self.capacity:
+                break
+            if key not in self.users:
+                evicted.append(key)
+                freed += len(value) + self.ENTRY_OVERHEAD
+        if self.size - freed + size > self.capacity:
+            return False
+        for key in evicted:
+            del self.items[key]
+        self.size -= freed
+        return True
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class BoundedDecompressor:
+    """
+    Streaming decompressor of a codec of CODECS whose output is capped
+
+    decompress and flush raise ValueError as soon as the data decompresses to more than
+    max_length bytes in total, having produced at most STREAM_BUFFER_SIZE bytes beyond it, so
+    a small compressed body cannot expand into a large allocation.
+
+    Args:
+        - codec (str): Codec of CODECS
+        - max_length (int): Maximum bytes of decompressed output
+    """
+
+    def __init__(self, codec: str, max_length: int) -> None:
+        self.max_length = max_length
+        self.length = 0
+        self.chunks: List[bytes] = []
+        if codec == "zstd":
+            # zstandard has no max_length, its output is written to self in chunks instead
+            self.zlib_decompressor = None
+            self.zstd_writer = zstandard.ZstdDecompressor().stream_writer(
+                self, write_size=STREAM_BUFFER_SIZE
+            )
+        else:
+            self.zlib_decompressor = zlib.decompressobj()
+            self.zstd_writer = None
+
+    def decompress(self, data) -> bytes:
+        if self.zstd_writer is not None:
+            self.zstd_writer.write(data)
+            data, self.chunks = b"".join(self.chunks), []
+            return data
+        # Asking one byte more than the remaining length tells whether it is exceeded
+        data = self.zlib_decompressor.decompress(
+            data, self.max_length - self.length + 1
+        )
+        self.write(data)
+        return data
+
+    def flush(self) -> bytes:
+        if self.zstd_writer is not None:
+            return b""
+        data = self.zlib_decompressor.flush()
+        self.write(data)
+        return data
+
+    def write(self, data) -> int:
+        # Count the decompressed output (the zstd writer calls it with each chunk)
+        self.length += len(data)
+        if self.length > self.max_length:
+            raise ValueError(f"data decompresses to more than {self.max_length} bytes")
+        if self.zstd_writer is not None:
+            self.chunks.append(bytes(data))
+        return len(data)
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping file names to the tracker shards that own them
+
+    Args:
+        - shards (List[str]): Addresses ("ip:port") of the tracker shards
+        - virtual_nodes (int): Number of points of each shard on the ring
+    """
+
+    def __init__(self, shards: List[str], virtual_nodes: int = VIRTUAL_NODES) -> None:
+        self.shards = list(dict.fromkeys(shards))
+        self.ring: List[Tuple[int, str]] = sorted(
+            (HashRing.hash(f"{shard}#{index}"), shard)
+            for shard in self.shards
+            for index in range(virtual_nodes)
+        )
+        self.points = [point for point, _ in self.ring]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def lookup(self, key: str, count: int = 1) -> List[str]:
+        """
+        Return the owner shard of key followed by its replicas (next distinct shards clockwise)
+
+        Args:
+            - key (str): File name
+            - count (int): Number of shards holding the key (owner + replicas)
+        """
+        count = min(count, len(self.shards))
+        result: List[str] = []
+        index = bisect.bisect(self.points, HashRing.hash(key))
+        while len(result) < count:
+            _, shard = self.ring[index % len(self.ring)]
+            if shard not in result:
+                result.append(shard)
+            index += 1
+        return result
+
+
+class TrackerConnection:
+    """
+    Represent the connection from the node to a single tracker shard
+
+    Args:
+        - ip (str): IP Address of the tracker
+        - port (int): Port number of the tracker
+        - sock (socket.socket): Socket for sending message to tracker, None before connect
+        - lock (threading.Lock): Serialize request/response exchanges on the socket
+        - alive (bool): Whether the tracker answered the handshake and is still reachable
+    """
+
+    def __init__(self, ip: str, port: int) -> None:
+        self.ip = ip
+        self.port = port
+        self.sock: socket.socket | None = None
+        self.reader = None
+        self.lock = Lock()
+        self.alive = False
+
+    @property
+    def address(self) -> str:
+        return f"{self.ip}:{self.port}"
+
+    def connect(self) -> None:
+        # Every exchange with the tracker waits at most REQUEST_TIMEOUT seconds, so a hung or
+        # overloaded tracker cannot block the fetches, publishes and searches of the node
+        self.sock = socket.create_connection(
+            (self.ip, self.port), timeout=REQUEST_TIMEOUT
+        )
+        self.reader = self.sock.makefile("rb")
+
+    def send(self, msg: str) -> None:
+        # Send a message that the tracker does not answer
+        with self.lock:
+            NodeUtils.send_line(self.sock, msg)
+
+    def request(self, msg: str) -> str:
+        # Send a single-line request and wait for the single-line response
+        # A tracker that fails or times out is left: a late response would be read as the
+        # response of the next request
+        try:
+            with self.lock:
+                NodeUtils.send_line(self.sock, msg)
+                response = NodeUtils.recv_line(self.reader)
+        except OSError:
+            self.close()
+            raise
+        if response is None:
+            self.close()
+            raise ConnectionError(f"Tracker {self.address} closed the connection")
+        return response
+
+    def close(self) -> None:
+        self.alive = False
+        if self.sock is not None:
+            self.sock.close()
+
+
+class FetchHandle:
+    """
+    Progress and control of a fetch started with Node.fetch_async
+
+    The fetch runs in its own thread and downloads into its own temp folder, so several
+    fetches can run at once. wait() blocks until it ends, cancel() stops its downloads after
+    the pieces being received and leaves the repo untouched.
+
+    Args:
+        - fetch_id (int): Id of the fetch in its node
+        - files (List[str]): Requested files
+        - status (str): running, done, cancelled or failed
+        - combined_files (List[str]): Files written to the repo once the fetch is done
+        - temp_folder (str): Folder of the pieces being downloaded, removed at the end
+    """
+
+    def __init__(self, fetch_id: int, files: List[str]) -> None:
+        self.fetch_id = fetch_id
+        self.files = files
+        self.status = "running"
+        self.error: str | None = None
+        self.combined_files: List[str] = []
+        self.total_pieces = 0
+        self.done_pieces = 0
+        self.received_bytes = 0
+        self.start_time = time.monotonic()
+        self.end_time: float | None = None
+        self.temp_folder = os.path.join(TEMP_FOLDER, str(fetch_id))
+        self.lock = Lock()
+        self.cancel_event = Event()
+        self.done_event = Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def done(self) -> bool:
+        return self.done_event.is_set()
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        # Block until the fetch ends, False if it is still running after timeout seconds
+        return self.done_event.wait(timeout)
+
+    def add_piece(self, received: int) -> None:
+        # Count a downloaded piece of received bytes, called by the download threads
+        with self.lock:
+            self.done_pieces += 1
+            self.received_bytes += received
+
+    def finish(self, status: str, error: str = None) -> None:
+        self.status = status
+        self.error = error
+        self.end_time = time.monotonic()
+        self.done_event.set()
+
+    def progress(self) -> Dict:
+        elapsed = (self.end_time or time.monotonic()) - self.start_time
+        return {
+            "fetch_id": self.fetch_id,
+            "files": self.files,
+            "status": self.status,
+            "pieces": self.done_pieces,
+            "total_pieces": self.total_pieces,
+            "received_bytes": self.received_bytes,
+            "seconds": round(elapsed, 2),
+            "throughput_mb_s": (
+                round(self.received_bytes / elapsed / 2**20, 2) if elapsed else 0.0
+            ),
+        }
+
+    def __str__(self) -> str:
+        progress = self.progress()
+        return (
+            f"[{self.fetch_id}] {self.status} {' '.join(self.files)}: "
+            f"{progress['pieces']}/{progress['total_pieces']} pieces, "
+            f"{progress['received_bytes'] / 2**20:.1f} MB in {progress['seconds']}s "
+            f"({progress['throughput_mb_s']} MB/s)"
+            + (f", {self.error}" if self.error else "")
+        )
 
 
 class Node:
@@ -50,21 +727,48 @@ class Node:
     Args:
         - tracker_ip (str): IP Address of the tracker
         - tracker_port (int): Port number of the tracker
-        - tracker_send_socket (socket.socket): Socket for sending message to tracker
+        - trackers (Dict[str, TrackerConnection]): Connections to every tracker shard
+        - ring (HashRing): Consistent hash ring mapping file names to tracker shards
+        - replicas (int): Number of shards each file is announced to
+        - known_peers (Dict[Tuple[str, int], Dict]): Peers learnt from the tracker and peer exchange
         - upload_socket (socket.socket): Socket for listening upload requests
-        - pieces (List[Piece]): List of pieces that the node has
+        - pieces (PieceTable): Pieces that the node has
         - upload_listening_request_thread (threading.Thread): Thread for listening upload requests
+        - metrics (MetricsRegistry): Counters and histograms of the transfers, shown by the stats command
+        - buffer_pool (BufferPool): Reusable buffers bounding the memory used by file data
+        - compression (str): Codecs asked for when downloading ("off", "auto" or a codec)
+        - compressed_pieces (ByteLRU): Compressed pieces already sent, by (piece hash, codec)
+        - hot_pieces (ByteLRU): Recently uploaded pieces kept in memory, by piece hash
+        - fetches (Dict[int, FetchHandle]): Fetches started on the node, by fetch id
     """
 
     def __init__(
-        self, tracker_ip="127.0.0.1", tracker_port=8000, upload_IP="127.0.0.1"
+        self,
+        tracker_ip="127.0.0.1",
+        tracker_port=8000,
+        upload_IP="127.0.0.1",
+        cluster: List[Tuple[str, int]] = None,
+        replicas: int = 1,
+        metrics_port: int = None,
+        upload_rate: int = None,
+        buffer_memory: int = BUFFER_MEMORY,
+        compression: str = "off",
+        compression_cache: int = COMPRESSION_CACHE,
+        piece_cache: int = PIECE_CACHE,
     ) -> None:
-        # socket for sending message to tracker
-        self.tracker_send_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # connections for sending message to the trackers, a single tracker is a one-shard cluster
+        cluster = cluster or [(tracker_ip, tracker_port)]
+        self.trackers: Dict[str, TrackerConnection] = {}
+        for ip, port in cluster:
+            connection = TrackerConnection(ip, port)
+            self.trackers[connection.address] = connection
+        self.ring = HashRing(list(self.trackers.keys()))
+        self.replicas = replicas
         # socket for listening upload requests
         self.upload_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.upload_socket.bind((upload_IP, 0))
-        self.upload_socket.listen(10)
+        # Room for the connections of a flash crowd waiting to be accepted
+        self.upload_socket.listen(socket.SOMAXCONN)
 
         self.tracker_ip = tracker_ip
         self.tracker_port = tracker_port
@@ -75,7 +779,10 @@ class Node:
             os.makedirs(directory, exist_ok=True)
 
         # Pieces Info
-        self.pieces: List[Piece] = []
+        self.pieces = PieceTable(PIECE_SIZE)
+
+        # Every read and write of file data streams through these buffers
+        self.buffer_pool = BufferPool(buffer_memory)
 
         # Thread for listening upload requests
         self.upload_listening_request_thread = Thread(
@@ -84,8 +791,106 @@ class Node:
             daemon=True,
         )
 
-        self.pieces = NodeUtils.generate_pieces_from_repo_files(
-            folder_name=REPO_FOLDER, piece_size=PIECE_SIZE
+        # Thread for announcing to the tracker that the node is still alive
+        self.heartbeat_thread = Thread(target=self.heartbeat, daemon=True)
+
+        # Peers known without asking the tracker: (ip, upload port) -> {"files": {file: piece count}, "seen": time}
+        self.known_peers: Dict[Tuple[str, int], Dict] = {}
+        self.known_peers_lock = Lock()
+        # Thread for gossiping known peers with other nodes
+        self.pex_thread = Thread(target=self.peer_exchange, daemon=True)
+
+        # Set when the node is stopped, ends the heartbeat and peer exchange loops
+        self.stopped = Event()
+
+        # Fetches run in their own threads, their files are combined one fetch at a time
+        self.fetches: Dict[int, FetchHandle] = {}
+        self.fetch_ids = itertools.count(1)
+        self.fetches_lock = Lock()
+        self.combine_lock = Lock()
+        # Number of running fetches relying on each piece of the store, a pinned piece is
+        # not removed when a file stops using it (guarded by combine_lock)
+        self.pinned_pieces: Dict[str, int] = {}
+
+        # Metrics, optionally exposed in the Prometheus format on localhost:metrics_port
+        self.metrics = MetricsRegistry()
+        self.downloaded_bytes = self.metrics.counter(
+            "node_downloaded_bytes_total", "Bytes downloaded from each peer", ("peer",)
+        )
+        self.uploaded_bytes = self.metrics.counter(
+            "node_uploaded_bytes_total", "Bytes uploaded to each peer IP", ("peer",)
+        )
+        self.piece_download_time = self.metrics.histogram(
+            "node_piece_download_seconds", "Time to download a piece, connect included"
+        )
+        self.connect_time = self.metrics.histogram(
+            "node_peer_connect_seconds", "Time to connect to a peer"
+        )
+        self.download_queue_depth = self.metrics.gauge(
+            "node_download_queue_pieces", "Pieces waiting to be downloaded"
+        )
+        self.active_uploads = self.metrics.gauge(
+            "node_active_uploads", "Upload requests being handled"
+        )
+        self.metrics.gauge(
+            "node_stream_buffer_bytes",
+            "Bytes of stream buffers in use",
+            callback=self.buffer_pool.in_use,
+        )
+        self.cache_lookups = self.metrics.counter(
+            "node_cache_lookups_total",
+            "Lookups of the piece caches",
+            ("cache", "result"),
+        )
+        self.compressed_uploads = self.metrics.counter(
+            "node_compressed_uploads_total", "Pieces sent by codec", ("codec",)
+        )
+        self.compression_saved_bytes = self.metrics.counter(
+            "node_compression_saved_bytes_total", "Bytes not sent thanks to compression"
+        )
+        self.tracker_request_time = self.metrics.histogram(
+            "node_tracker_request_seconds",
+            "Round trip time of tracker requests",
+            ("command",),
+        )
+        self.metrics_server = (
+            MetricsServer(self.metrics, port=metrics_port) if metrics_port else None
+        )
+
+        # Optional limit of the upload bandwidth (bytes per second)
+        self.upload_limiter = RateLimiter(upload_rate) if upload_rate else None
+
+        # Wire compression: codecs asked for as a downloader, compressed pieces kept as an
+        # uploader so a piece is compressed once for all its requesters
+        if compression == "off":
+            self.compression: Tuple[str, ...] = ()
+        elif compression == "auto":
+            self.compression = CODECS
+        else:
+            self.compression = (compression,)
+        self.compressed_pieces = ByteLRU(
+            compression_cache, self.cache_lookups, "compressed"
+        )
+        self.metrics.gauge(
+            "node_compressed_cache_bytes",
+            "Bytes of compressed pieces cached",
+            callback=lambda: self.compressed_pieces.size,
+        )
+
+        # Pieces requested by many peers at once (e.g the first pieces of a new file) are
+        # served from memory instead of the disk, 0 turns the cache off
+        self.hot_pieces = ByteLRU(piece_cache, self.cache_lookups, "hot")
+        self.metrics.gauge(
+            "node_hot_cache_bytes",
+            "Bytes of hot pieces cached",
+            callback=lambda: self.hot_pieces.size,
+        )
+
+        NodeUtils.generate_pieces_from_repo_files(
+            folder_name=REPO_FOLDER,
+            piece_size=PIECE_SIZE,
+            piece_table=self.pieces,
+            buffer_pool=self.buffer_pool,
         )
 
     def upload_listening_request(self, upload_socket: socket.socket) -> None:
@@ -112,16 +917,38 @@ class Node:
             - conn (socket.socket): Socket connection
             - addr (Tuple[str, int]):
         """
-        with conn:
-            msg = conn.recv(1024).decode()
-            if msg.startswith("find"):
-                self.explore_pieces_request_handler(msg, conn)
-            elif msg.startswith("request"):
-                self.upload_pieces_request_handler(msg.split()[1], conn)
+        self.active_uploads.inc()
+        try:
+            with conn:
+                msg = NodeUtils.recv_line(conn.makefile("rb"))
+                if msg is None:
+                    return
+                if msg.startswith("find"):
+                    self.explore_pieces_request_handler(msg, conn)
+                elif msg.startswith("request"):
+                    # request <piece hash> [--compress=codec,codec]
+                    # request <file> <piece ids> [--compress=codec,codec]
+                    args = [arg for arg in msg.split() if not arg.startswith("--")]
+                    codecs = []
+                    for arg in msg.split():
+                        if arg.startswith("--compress="):
+                            codecs = arg.split("=", 1)[1].split(",")
+                    if len(args) == 2:
+                        self.upload_pieces_request_handler(args[1], conn, codecs)
+                    elif len(args) == 3:
+                        self.upload_batch_request_handler(
+                            args[1], args[2], conn, codecs
+                        )
+                elif msg.startswith("pex"):
+                    self.peer_exchange_request_handler(msg, conn)
+        finally:
+            self.active_uploads.dec()
 
     def explore_pieces_request_handler(self, msg: str, conn: socket.socket) -> None:
         """
         Handle the explore pieces request from corresponding node and send the pieces information back
+
+        The pieces of each file are answered as their hashes, in piece order
         Args:
             - msg (str): message content
             - conn (socket.socket): Socket connection
@@ -129,55 +956,255 @@ class Node:
         response = {}
         requested_files = msg.split()[1:]
         for file_name in requested_files:
-            for piece in self.pieces:
-                if piece.original_filename == file_name:
-                    response.setdefault(file_name, []).append(f"{piece.piece_id}")
+            if file_name in self.pieces:
+                response[file_name] = self.pieces.hashes_of(file_name)
         conn.sendall(json.dumps(response).encode())
 
+    def peer_exchange_request_handler(self, msg: str, conn: socket.socket) -> None:
+        """
+        Merge the peers gossiped by the corresponding node and send back the peers this node knows
+        Args:
+            - msg (str): message content (pex <json view of the sender>)
+            - conn (socket.socket): Socket connection
+        """
+        self.merge_peer_view(json.loads(msg.split(" ", 1)[1]))
+        conn.sendall(json.dumps(self.peer_view()).encode())
+
     def upload_pieces_request_handler(
-        self, piece_name: str, conn: socket.socket
+        self, piece_hash: str, conn: socket.socket, codecs: List[str] = None
     ) -> None:
-        piece_path = os.path.join(PIECES_FOLDER, piece_name)
-        with open(piece_path, "rb") as piece_file:
-            with mmap.mmap(
-                piece_file.fileno(), length=0, access=mmap.ACCESS_READ
-            ) as mmapped_file:
-                chunk = mmapped_file.read(PIECE_SIZE)
-                conn.sendall(chunk)
-
-    def start(self) -> None:
-        self.handshake()
-        self.upload_listening_request_thread.start()
-        self.node_command_shell()
-
-    def handshake(self) -> None:
-        # Handshake with the tracker by sending the first connection message and node information (files, pieces information) to tracker
-        self.tracker_send_socket.connect((self.tracker_ip, self.tracker_port))
-        time.sleep(0.1)
-        self.tracker_send_socket.send("First Connection".encode())
-
-        file_info: str = NodeUtils.generate_files_info_from(folder_name=REPO_FOLDER)
+        """
+        Send a piece, compressed with the first codec of codecs this node supports if it is worth it
 
-        # (IP Address) (Port for sending) (Port for uploading) (File info)
+        When the requester accepts compression, the body is preceded by a line naming the codec
+        used ("raw" if none), otherwise the raw piece is sent alone as before.
+        Args:
+            - piece_hash (str): hash of the requested piece
+            - conn (socket.socket): Socket connection
+            - codecs (List[str]): codecs accepted by the requester, in order of preference
+        """
+        if not NodeUtils.is_piece_hash(piece_hash):
+            return
+        codec, payload = self.piece_payload(piece_hash, codecs)
+        try:
+            if codecs:
+                NodeUtils.send_line(conn, codec)
+
+            if payload is not None:
+                sent = self.send_payload(conn, payload)
+            else:
+                with open(NodeUtils.piece_path(piece_hash), "rb") as piece_file:
+                    sent = self.send_file(conn, piece_file)
+        finally:
+            if codec == "raw" and payload is not None:
+                self.hot_pieces.release(piece_hash)
+        self.uploaded_bytes.inc(sent, (conn.getpeername()[0],))
+
+    def upload_batch_request_handler(
+        self,
+        file_name: str,
+        piece_ids: str,
+        conn: socket.socket,
+        codecs: List[str] = None,
+    ) -> None:
+        """
+        Send several pieces of a file as one stream of framed pieces
 
-        node_info = (
-            self.upload_ip
-            + " "
-            + str(self.tracker_send_socket.getsockname()[1])
-            + " "
-            + str(self.upload_socket.getsockname()[1])
-            + " "
-            + file_info
+        Each piece is preceded by a header line "<piece id> <piece hash> <codec> <length>" and
+        followed by its length bytes. Headers and pieces held in memory are gathered into
+        vectored writes (sendmsg), pieces read from the disk go out with sendfile. Pieces this
+        node does not have are left out of the stream.
+        Args:
+            - file_name (str): file the pieces belong to
+            - piece_ids (str): ids of the pieces, as ranges and single ids (e.g 100-199,205)
+            - conn (socket.socket): Socket connection
+            - codecs (List[str]): codecs accepted by the requester, in order of preference
+        """
+        sent = 0
+        buffers: List[bytes] = []
+        # Pieces of buffers from the hot piece cache, released once sent
+        hot_hashes: List[str] = []
+        try:
+            for piece_id in NodeUtils.parse_piece_ids(
+                piece_ids, self.pieces.piece_count(file_name)
+            ):
+                try:
+                    piece_hash = self.pieces.piece_hash(file_name, piece_id)
+                    codec, payload = self.piece_payload(piece_hash, codecs)
+                    if payload is not None:
+                        if codec == "raw":
+                            hot_hashes.append(piece_hash)
+                        buffers.append(
+                            f"{piece_id} {piece_hash} {codec} {len(payload)}\n".encode()
+                        )
+                        buffers.append(payload)
+                        if sum(len(buffer) for buffer in buffers) >= BATCH_SEND_SIZE:
+                            sent += self.send_buffers(conn, buffers)
+                            buffers = []
+                            self.release_hot_pieces(hot_hashes)
+                        continue
+                    with open(NodeUtils.piece_path(piece_hash), "rb") as piece_file:
+                        piece_length = os.fstat(piece_file.fileno()).st_size
+                        buffers.append(
+                            f"{piece_id} {piece_hash} raw {piece_length}\n".encode()
+                        )
+                        sent += self.send_buffers(conn, buffers)
+                        buffers = []
+                        self.release_hot_pieces(hot_hashes)
+                        sent += self.send_file(conn, piece_file)
+                except (KeyError, FileNotFoundError):
+                    # The file changed since the requester listed its pieces
+                    continue
+            sent += self.send_buffers(conn, buffers)
+        finally:
+            self.release_hot_pieces(hot_hashes)
+        self.uploaded_bytes.inc(sent, (conn.getpeername()[0],))
+
+    def release_hot_pieces(self, piece_hashes: List[str]) -> None:
+        # Release the hot cache entries of pieces sent, and empty the list
+        for piece_hash in piece_hashes:
+            self.hot_pieces.release(piece_hash)
+        piece_hashes.clear()
+
+    def piece_payload(
+        self, piece_hash: str, codecs: List[str] = None
+    ) -> Tuple[str, bytes | None]:
+        # Codec and bytes to send for a piece: compressed with the first codec of codecs this
+        # node supports if it is worth it, else raw from the hot piece cache (to release once
+        # sent), or None when the piece is sent from the disk
+        codec = next((codec for codec in codecs or [] if codec in CODECS), None)
+        payload = self.compressed_piece(piece_hash, codec) if codec else None
+        if payload:
+            self.compressed_uploads.inc(1, (codec,))
+            self.compression_saved_bytes.inc(
+                os.path.getsize(NodeUtils.piece_path(piece_hash)) - len(payload)
+            )
+            return codec, payload
+        if self.hot_pieces.capacity > 0:
+            # Served from the hot piece cache, the second miss of a piece reads it once for
+            # the next requests (other misses, and requests arriving while it is read, fall
+            # back to sendfile)
+            piece_path = NodeUtils.piece_path(piece_hash)
+            piece_length = os.path.getsize(piece_path)
+            payload = self.hot_pieces.get_or_load(
+                piece_hash,
+                lambda: NodeUtils.map_file(piece_path, piece_length),
+                piece_length,
+            )
+        return "raw", payload
+
+    def send_file(self, conn: socket.socket, piece_file) -> int:
+        # The piece goes from the page cache to the socket with sendfile, it is never
+        # copied into the memory of the node
+        if self.upload_limiter is None:
+            return conn.sendfile(piece_file)
+        piece_length = os.fstat(piece_file.fileno()).st_size
+        sent = 0
+        while sent < piece_length:
+            count = min(UPLOAD_CHUNK_SIZE, piece_length - sent)
+            self.upload_limiter.consume(count)
+            sent += conn.sendfile(piece_file, sent, count)
+        return sent
+
+    def send_buffers(self, conn: socket.socket, buffers: List[bytes]) -> int:
+        # Send buffers with vectored writes (sendmsg), each one sending as many buffers as the
+        # socket takes, or UPLOAD_CHUNK_SIZE bytes charged to the rate limiter when it is set
+        total = sum(len(buffer) for buffer in buffers)
+        views = [memoryview(buffer) for buffer in buffers if buffer]
+        charged = 0  # Bytes charged to the rate limiter and not sent yet
+        while views:
+            chunk = views[:SENDMSG_MAX_BUFFERS]
+            if self.upload_limiter is not None:
+                chunk, size = [], 0
+                for view in views[:SENDMSG_MAX_BUFFERS]:
+                    if size == UPLOAD_CHUNK_SIZE:
+                        break
+                    chunk.append(view[: UPLOAD_CHUNK_SIZE - size])
+                    size += len(chunk[-1])
+                self.upload_limiter.consume(size - charged)
+                charged = size
+            sent = conn.sendmsg(chunk)
+            charged -= min(sent, charged)
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views.pop(0))
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
+        return total
+
+    def send_payload(self, conn: socket.socket, payload: bytes) -> int:
+        # Send bytes held in memory, in UPLOAD_CHUNK_SIZE blocks when the upload rate is limited
+        if self.upload_limiter is None:
+            conn.sendall(payload)
+            return len(payload)
+        sent = 0
+        with memoryview(payload) as view:
+            while sent < len(view):
+                count = min(UPLOAD_CHUNK_SIZE, len(view) - sent)
+                self.upload_limiter.consume(count)
+                conn.sendall(view[sent : sent + count])
+                sent += count
+        return sent
+
+    def compressed_piece(self, piece_hash: str, codec: str) -> bytes:
+        # Piece compressed with codec, from the cache if possible, empty if not worth it
+        # The requesters of a piece being compressed wait for it instead of compressing it
+        return self.compressed_pieces.get_or_wait(
+            (piece_hash, codec), lambda: self.compress_piece(piece_hash, codec)
         )
 
-        self.tracker_send_socket.sendall(node_info.encode())
+    def compress_piece(self, piece_hash: str, codec: str) -> bytes:
+        # Piece compressed with codec, empty if not worth it
+        # A fast compression of the first bytes tells whether the piece is compressible
+        payload = b""
+        with (
+            open(NodeUtils.piece_path(piece_hash), "rb") as piece_file,
+            self.buffer_pool.buffer() as buffer,
+        ):
+            read = piece_file.readinto(buffer[:COMPRESSION_SAMPLE_SIZE])
+            if NodeUtils.sample_size(buffer[:read]) <= read * MAX_COMPRESSION_RATIO:
+                compressor = NodeUtils.compressor(codec)
+                chunks = []
+                piece_length = 0
+                while read:
+                    chunks.append(compressor.compress(buffer[:read]))
+                    piece_length += read
+                    read = piece_file.readinto(buffer)
+                chunks.append(compressor.flush())
+                payload = b"".join(chunks)
+                if len(payload) > piece_length * MAX_COMPRESSION_RATIO:
+                    payload = b""
+        return payload
+
+    def start(self, shell: bool = True) -> None:
+        """
+        Join the trackers, start serving the pieces, then run the command shell
 
-        print(
-            "Sending socket address: "
-            + self.tracker_send_socket.getsockname()[0]
-            + ":"
-            + str(self.tracker_send_socket.getsockname()[1])
+        With shell=False start returns at once, a script then drives the node through
+        fetch_async, search, discover and stop.
+        """
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        self.handshake()
+        self.upload_listening_request_thread.start()
+        self.heartbeat_thread.start()
+        self.pex_thread.start()
+        if shell:
+            self.node_command_shell()
+
+    def handshake(self) -> None:
+        # Handshake with every tracker shard by sending the first connection message and the information of the files the shard owns
+        file_info = json.loads(
+            NodeUtils.generate_files_info_from(
+                folder_name=REPO_FOLDER, piece_table=self.pieces
+            )
         )
+        for tracker in self.trackers.values():
+            self.join_tracker(tracker, file_info)
+
+        if not any(tracker.alive for tracker in self.trackers.values()):
+            raise ConnectionError("No tracker is reachable")
 
         print(
             "Upload socket address: "
@@ -186,20 +1213,197 @@ class Node:
             + str(self.upload_socket.getsockname()[1])
         )
 
-        print("[Status]: ", self.tracker_send_socket.recv(1024).decode())
+    def join_tracker(
+        self, tracker: TrackerConnection, file_info: Dict[str, Dict]
+    ) -> None:
+        """
+        Connect to a tracker shard and announce the node with the files the shard owns
 
-    def fetch(self, message: str) -> None:
-        # Fetch the files by sending the request to the tracker and get the pieces information from the peers
+        Args:
+            - tracker (TrackerConnection): the tracker shard, alive once it answered
+            - file_info (Dict[str, Dict]): information of the files of the repo
+        """
         try:
-            # Filter out the files that are already available in the repo
-            available_files = os.listdir(REPO_FOLDER)
-            for file in message.split()[1:]:
-                if file in available_files:
-                    print(f"[Warning]: You already have file {file}")
+            # Requests wait for the end of the handshake
+            with tracker.lock:
+                tracker.connect()
+                NodeUtils.send_line(tracker.sock, "First Connection")
+
+                # (IP Address) (Port for sending) (Port for uploading) (File info)
+
+                node_info = (
+                    self.upload_ip
+                    + " "
+                    + str(tracker.sock.getsockname()[1])
+                    + " "
+                    + str(self.upload_socket.getsockname()[1])
+                    + " "
+                    + self.shard_files_info(tracker.address, file_info)
+                )
 
-            requested_files = [
-                file for file in message.split()[1:] if file not in available_files
+                NodeUtils.send_line(tracker.sock, node_info)
+
+                print(
+                    "Sending socket address: "
+                    + tracker.sock.getsockname()[0]
+                    + ":"
+                    + str(tracker.sock.getsockname()[1])
+                )
+                status = NodeUtils.recv_line(tracker.reader)
+                tracker.alive = status == "Connected"
+            print(f"[Status]: {tracker.address}", status)
+        except Exception as e:
+            print(f"[Error]: Failed to connect to tracker {tracker.address}: {e}")
+        if not tracker.alive:
+            tracker.close()
+
+    def shard_files_info(self, shard: str, file_info: Dict[str, Dict]) -> str:
+        # Keep the files whose owner or replicas include the shard
+        return json.dumps(
+            {
+                file_name: info
+                for file_name, info in file_info.items()
+                if shard in self.ring.lookup(file_name, self.replicas)
+            }
+        )
+
+    def heartbeat(self) -> None:
+        # Periodically tell the trackers that the node is alive, so it does not get expired
+        # The trackers left (unreachable, restarted or that expired the node) are joined
+        # again, announcing the files of the repo
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            left = [tracker for tracker in self.trackers.values() if not tracker.alive]
+            if left:
+                file_info = json.loads(
+                    NodeUtils.generate_files_info_from(
+                        REPO_FOLDER, piece_table=self.pieces
+                    )
+                )
+                for tracker in left:
+                    self.join_tracker(tracker, file_info)
+            for tracker in self.trackers.values():
+                if not tracker.alive or tracker in left:
+                    continue
+                try:
+                    tracker.send("heartbeat")
+                except Exception as e:
+                    tracker.close()
+                    print(
+                        f"[Error]: Failed to send heartbeat to tracker {tracker.address}: {e}"
+                    )
+
+    def tracker_request(self, msg: str, file_name: str = None) -> str:
+        """
+        Send a single-line request to the tracker shard owning file_name, falling back to its replicas
+
+        Args:
+            - msg (str): request message (without the trailing newline)
+            - file_name (str): file that routes the request, None for the first reachable shard
+        """
+        if file_name is None:
+            shards = list(self.trackers.keys())
+        else:
+            shards = self.ring.lookup(file_name, self.replicas)
+        for shard in shards:
+            tracker = self.trackers[shard]
+            if not tracker.alive:
+                continue
+            try:
+                with self.tracker_request_time.time((msg.split(" ", 1)[0],)):
+                    return tracker.request(msg)
+            except Exception as e:
+                print(f"[Error]: Tracker {shard} failed: {e}")
+        raise ConnectionError(f"No tracker shard is reachable for {file_name}")
+
+    def tracker_broadcast(self, msg: str) -> Dict[str, str]:
+        # Send a request to every reachable tracker shard and collect the responses
+        responses = {}
+        for shard, tracker in self.trackers.items():
+            if not tracker.alive:
+                continue
+            try:
+                responses[shard] = tracker.request(msg)
+            except Exception as e:
+                print(f"[Error]: Tracker {shard} failed: {e}")
+        return responses
+
+    def fetch_peers(
+        self, files: List[str], offset: int = 0, limit: int = PEERS_PAGE_SIZE
+    ) -> Dict:
+        """
+        Ask the tracker shards for one page of the peers holding each of the files
+
+        Args:
+            - files (List[str]): requested file names
+            - offset (int): position of the page in the tracker's ranking of each file's holders
+            - limit (int): maximum number of peers per file
+        """
+        # Group the files by their owner shard and replicas so each group gets a single
+        # request, which fails over to shards that all hold every file of the group
+        files_by_shard: Dict[Tuple[str, ...], List[str]] = {}
+        for file in files:
+            files_by_shard.setdefault(
+                tuple(self.ring.lookup(file, self.replicas)), []
+            ).append(file)
+
+        data = {"files": {}, "exclude": []}
+        for shard_files in files_by_shard.values():
+            try:
+                response = json.loads(
+                    self.tracker_request(
+                        f"fetch --offset={offset} --limit={limit} {' '.join(shard_files)}",
+                        file_name=shard_files[0],
+                    )
+                )
+            except ConnectionError as e:
+                print(f"[Error]: {e}")
+                data["exclude"].extend(shard_files)
+                continue
+            data["files"].update(response["files"])
+            data["exclude"].extend(response["exclude"])
+        return data
+
+    def fetch_async(self, files: List[str]) -> FetchHandle:
+        """
+        Start fetching files in the background and return the handle of the fetch
+
+        Args:
+            - files (List[str]): files to fetch, files of the repo are only fetched again if
+              a newer version exists
+        """
+        handle = FetchHandle(next(self.fetch_ids), list(dict.fromkeys(files)))
+        with self.fetches_lock:
+            self.fetches[handle.fetch_id] = handle
+        Thread(target=self.run_fetch, args=(handle,), daemon=True).start()
+        return handle
+
+    def prune_fetches(self) -> None:
+        # Only the last FINISHED_FETCHES_KEPT finished fetches stay listed by jobs
+        with self.fetches_lock:
+            finished = [
+                fetch_id for fetch_id, handle in self.fetches.items() if handle.done
             ]
+            for fetch_id in finished[: max(0, len(finished) - FINISHED_FETCHES_KEPT)]:
+                del self.fetches[fetch_id]
+
+    def fetch(self, message: str) -> FetchHandle:
+        # Fetch the files of a "fetch [files]" message and wait for the end of the fetch
+        handle = self.fetch_async(message.split()[1:])
+        handle.wait()
+        return handle
+
+    def run_fetch(self, handle: FetchHandle) -> None:
+        # Fetch the files by sending the request to the tracker and get the pieces information from the peers
+        os.makedirs(handle.temp_folder, exist_ok=True)
+        # Files of the repo that are already at their latest version, the fetch fails if any
+        # other requested file is not combined in the end
+        up_to_date: List[str] = []
+        # Pieces of the store that this fetch does not download
+        pinned_pieces: set = set()
+        try:
+            # Files already in the repo are only fetched again if a newer version exists
+            requested_files = handle.files
+            local_files = [file for file in requested_files if file in self.pieces]
 
             if len(requested_files) == 0:
                 return
@@ -209,95 +1413,381 @@ class Node:
                 "Fetching to tracker to get peers information may contain pieces of requested files..."
             )
 
-            tracker_sending_msg = f"fetch {' '.join(requested_files)}"
-            self.tracker_send_socket.sendall(tracker_sending_msg.encode())
-            data = self.tracker_send_socket.recv(1024).decode()
-            data = json.loads(data)
+            # Holders known through peer exchange (of the newest version gossiped) stand in
+            # for the tracker for the files not in the repo, and the piece hashes of these
+            # files come from the holders. The tracker is only asked for the other files,
+            # its holders of the same version as the gossiped ones are both used
+            known = self.known_holders(requested_files)["files"]
+            data = {
+                "files": {
+                    file: known[file]
+                    for file in requested_files
+                    if file in known and file not in local_files
+                },
+                "exclude": [],
+            }
+            manifests: Dict[str, List[str]] = {}
+            modified_times = {
+                file: file_data["modified"] for file, file_data in data["files"].items()
+            }
+            tracker_files = [
+                file for file in requested_files if file not in data["files"]
+            ]
+            if tracker_files:
+                tracker_data = self.fetch_peers(tracker_files)
+                for file, file_data in tracker_data["files"].items():
+                    manifests[file] = file_data.pop("piece_hashes")
+                    modified_times[file] = file_data["modified"]
+                self.remember_holders(tracker_data)
+                data["files"].update(tracker_data["files"])
+                for file in tracker_files:
+                    file_data = data["files"].get(file)
+                    if file not in known:
+                        continue
+                    if file_data is None:
+                        # The tracker has no holders of the file or is unreachable
+                        data["files"][file] = known[file]
+                        modified_times[file] = known[file]["modified"]
+                    elif known[file]["version"] == file_data["version"]:
+                        listed = {
+                            (peer_info["ip_addr"], int(peer_info["upload_port"]))
+                            for peer_info in file_data["peers"]
+                        }
+                        file_data["peers"].extend(
+                            peer_info
+                            for peer_info in known[file]["peers"]
+                            if (peer_info["ip_addr"], int(peer_info["upload_port"]))
+                            not in listed
+                        )
+                data["exclude"] = [
+                    file for file in tracker_data["exclude"] if file not in known
+                ]
             print("[Result]:")
             print(json.dumps(data, indent=4))
-            if "exclude" in data:
-                requested_files = [
-                    file for file in requested_files if file not in data["exclude"]
-                ]
+            for file in local_files:
+                if file not in data["files"]:
+                    print(f"[Warning]: You already have file {file}")
+                    up_to_date.append(file)
+                elif data["files"][file]["version"] == self.pieces.version(
+                    file
+                ) or modified_times[file] <= os.path.getmtime(
+                    os.path.join(REPO_FOLDER, file)
+                ):
+                    print(f"[Warning]: You already have the latest version of {file}")
+                    up_to_date.append(file)
+                    manifests.pop(file, None)
+                else:
+                    print(f"[Update]: {file} has a newer version, fetching its changes")
+            # Version wanted of each file, to ignore peers listing the pieces of another one
+            versions = {
+                file: data["files"][file]["version"]
+                for file in requested_files
+                if file in data["files"]
+            }
+            requested_files = [
+                file
+                for file in requested_files
+                if file not in data["exclude"] and file not in up_to_date
+            ]
 
-            # {'127.0.0.1:54782': {'ip_addr': '127.0.0.1', 'upload_port': 54781}, '127.0.0.1:54784': {'ip_addr': '127.0.0.1', 'upload_port': 54783}, 'tracker_ip': '127.0.0.1:8000'}
+            # {'files': {'1.pdf': {'piece_count': 3, 'file_size': 1048576, 'version': '9f86...', 'modified': 1732170000.0, 'total': 2, 'offset': 0, 'next_offset': None, 'peers': [{'peer_ip': '127.0.0.1:54782', 'ip_addr': '127.0.0.1', 'upload_port': 54781}, ...]}}, 'exclude': []}
 
             # Send request to other peers to get pieces information of those peers
-            if len(data) == 1 or len(requested_files) == 0:
-                print("[Warning]: No peers found that contain the requested files")
+            if len(requested_files) == 0:
+                if any(
+                    file in data["exclude"] and file not in local_files
+                    for file in handle.files
+                ):
+                    print("[Warning]: No peers found that contain the requested files")
                 return
 
             print("Requesting pieces information from peers...", end=" ")
             request_pieces_obj: Dict[Tuple[str, int], Dict[str, List[str]]] = {}
-            curr_pieces_info: Dict[str, List[str]] = {}
-            request_queues: Dict[Tuple[str, int], List[str]] = {}
-            display_data: Dict[Tuple[str, int], List[str]] = {}
-            for piece in self.pieces:
-                curr_pieces_info.setdefault(piece.original_filename, []).append(
-                    f"{piece.piece_id}"
-                )
 
-            for _, peer_info in data.items():
-                if (
-                    isinstance(peer_info, dict)
-                    and int(peer_info["upload_port"])
-                    != self.upload_socket.getsockname()[1]
-                ):
-                    ip_addr = peer_info["ip_addr"]
-                    upload_port = peer_info["upload_port"]
-                    pieces_info = self.request_pieces_info_from(
-                        ip_addr, upload_port, requested_files
+            # Query the sampled peers, asking the tracker for the next page of a file's
+            # holders only while none of the peers seen so far listed all of its pieces
+            # (holders known through peer exchange start at the first tracker page)
+            pending_files = requested_files
+            while pending_files:
+                files_by_peer: Dict[Tuple[str, int], List[str]] = {}
+                for file in pending_files:
+                    for peer_info in data["files"][file]["peers"]:
+                        peer = (peer_info["ip_addr"], int(peer_info["upload_port"]))
+                        if peer[1] == self.upload_socket.getsockname()[1]:
+                            continue
+                        files_by_peer.setdefault(peer, []).append(file)
+
+                for peer, files in files_by_peer.items():
+                    pieces_info = self.request_pieces_info_from(peer[0], peer[1], files)
+                    request_pieces_obj.setdefault(peer, {}).update(pieces_info)
+
+                next_page_files = [
+                    file
+                    for file in pending_files
+                    if data["files"][file]["next_offset"] is not None
+                    and not NodeUtils.pieces_covered(
+                        file, data["files"][file]["piece_count"], request_pieces_obj
                     )
-                    request_queues[(ip_addr, upload_port)] = []
-                    request_pieces_obj[(ip_addr, upload_port)] = pieces_info
-                    display_data[str((ip_addr, upload_port))] = []
+                ]
+                if not next_page_files:
+                    break
+                files_by_offset: Dict[int, List[str]] = {}
+                for file in next_page_files:
+                    files_by_offset.setdefault(
+                        data["files"][file]["next_offset"], []
+                    ).append(file)
+                data = {"files": {}, "exclude": []}
+                for next_offset, files in files_by_offset.items():
+                    page = self.fetch_peers(files, offset=next_offset)
+                    for file, file_data in page["files"].items():
+                        manifests.setdefault(file, file_data.pop("piece_hashes"))
+                        modified_times.setdefault(file, file_data["modified"])
+                    data["files"].update(page["files"])
+                    self.remember_holders(page)
+                pending_files = [
+                    file for file in next_page_files if file in data["files"]
+                ]
 
             print("Ok")
 
+            # The piece hashes of each file and the peers offering them
+            manifests = NodeUtils.choose_manifests(
+                requested_files, request_pieces_obj, manifests, versions
+            )
             for file in requested_files:
-                file_request_queue = NodeUtils.get_request_queue(
-                    file, request_pieces_obj, curr_pieces_info
-                )
-                for peer, pieces in file_request_queue.items():
-                    request_queues[peer].extend(pieces)
-                    display_data[str(peer)].extend(pieces)
+                if file not in manifests:
+                    print(f"[Warning]: No peer listed the pieces of file {file}")
+            requested_files = [file for file in requested_files if file in manifests]
+            offered_pieces: Dict[Tuple[str, int], List[str]] = {}
+            # File and piece id of every piece on each peer, to ask for it in a batch
+            piece_locations: Dict[Tuple[str, int], Dict[str, Tuple[str, int]]] = {}
+            for peer, pieces_info in request_pieces_obj.items():
+                for file in requested_files:
+                    if pieces_info.get(file) == manifests[file]:
+                        offered_pieces.setdefault(peer, []).extend(manifests[file])
+                        locations = piece_locations.setdefault(peer, {})
+                        for piece_id, piece_hash in enumerate(manifests[file]):
+                            locations.setdefault(piece_hash, (file, piece_id))
+
+            # Pieces already in the piece store, e.g from another file, are not downloaded,
+            # and stay in the store until the fetch ends even if the file using them changes
+            with self.combine_lock:
+                missing_pieces, stored_pieces = set(), set()
+                for file in requested_files:
+                    for piece_hash in manifests[file]:
+                        if os.path.exists(NodeUtils.piece_path(piece_hash)):
+                            stored_pieces.add(piece_hash)
+                        else:
+                            missing_pieces.add(piece_hash)
+                self.pin_pieces(stored_pieces)
+                pinned_pieces.update(stored_pieces)
+            request_queues = NodeUtils.get_request_queue(offered_pieces, missing_pieces)
+            handle.total_pieces = sum(len(queue) for queue in request_queues.values())
 
             # Display the optimize requested queue for each peer
-            for peer, queue in display_data.items():
-                display_data[peer] = str(queue)
+            display_data = {
+                str(peer): str([piece_hash[:12] for piece_hash in queue])
+                for peer, queue in request_queues.items()
+            }
 
             print(json.dumps(display_data, indent=2))
             print("Start downloading...")
             # Start downloading process
 
-            self.download_manager(request_queues)
+            # Files of formats that are already compressed are never asked compressed
+            compressible = {
+                piece_hash
+                for file in requested_files
+                if not file.lower().endswith(COMPRESSED_EXTENSIONS)
+                for piece_hash in manifests[file]
+            }
+            self.download_manager(request_queues, compressible, piece_locations, handle)
+            if handle.cancelled:
+                return
 
-            # Combine downloading pieces to create the requested files
-            self.combine_pieces(requested_files)
-            self.pieces.extend(
-                NodeUtils.generate_pieces_from_repo_files(
-                    folder_name=REPO_FOLDER,
-                    file_list=requested_files,
-                    piece_size=PIECE_SIZE,
+            # Combine the stored and downloaded pieces to create the requested files, the
+            # fetches running at once may patch the same files and collect the same pieces
+            with self.combine_lock:
+                handle.combined_files = self.combine_pieces(
+                    requested_files, manifests, modified_times, handle.temp_folder
                 )
-            )
 
             print("Combined pieces ok")
-            for file in os.listdir(TEMP_FOLDER):
-                os.unlink(os.path.join(TEMP_FOLDER, file))
-
-            # Publish new file info to tracker
-            new_file_info = NodeUtils.generate_files_info_from(REPO_FOLDER)
-            msg = f"publish {new_file_info}"
-            self.tracker_send_socket.send(msg.encode())
-            time.sleep(0.1)
-            response_status = self.tracker_send_socket.recv(1024).decode()
-            if response_status != "OK":
-                print("[Error]: Failed to publish new file info to tracker")
+
+            # Publish new file info to the tracker shards
+            self.publish()
 
         except Exception as e:
             print(traceback.format_exc())
             print(f"[Error]: Unexpected error during fetch: {e}")
+            handle.finish("failed", str(e))
+        finally:
+            shutil.rmtree(handle.temp_folder, ignore_errors=True)
+            with self.combine_lock:
+                self.unpin_pieces(pinned_pieces)
+            missing_files = [
+                file
+                for file in handle.files
+                if file not in handle.combined_files and file not in up_to_date
+            ]
+            if handle.done:
+                # Already finished as failed by an error
+                pass
+            elif handle.cancelled:
+                handle.finish("cancelled")
+            elif missing_files:
+                handle.finish("failed", f"could not fetch {' '.join(missing_files)}")
+            else:
+                handle.finish("done")
+            self.prune_fetches()
+            print(f"[Fetch]: {handle}")
+
+    def publish(self) -> None:
+        # Announce to every tracker shard the files of the repo that it owns
+        file_info = json.loads(
+            NodeUtils.generate_files_info_from(REPO_FOLDER, piece_table=self.pieces)
+        )
+        for shard, tracker in self.trackers.items():
+            if not tracker.alive:
+                continue
+            try:
+                response_status = tracker.request(
+                    f"publish {self.shard_files_info(shard, file_info)}"
+                )
+            except Exception as e:
+                response_status = str(e)
+            if response_status != "OK":
+                print(f"[Error]: Failed to publish new file info to tracker {shard}")
+
+    def peer_view(self) -> Dict:
+        # Build the peer exchange message: this node's own files and the most recently seen peers
+        now = time.time()
+        with self.known_peers_lock:
+            peers = sorted(
+                self.known_peers.items(), key=lambda item: item[1]["seen"], reverse=True
+            )[:PEX_MAX_ENTRIES]
+        own_files = {
+            file_name: {
+                "piece_count": self.pieces.piece_count(file_name),
+                "version": self.pieces.version(file_name),
+                "modified": os.path.getmtime(os.path.join(REPO_FOLDER, file_name)),
+            }
+            for file_name in list(self.pieces.file_ids)
+        }
+        return {
+            "self": {
+                "addr": [self.upload_ip, self.upload_socket.getsockname()[1]],
+                "files": own_files,
+            },
+            "peers": [
+                {
+                    "addr": list(peer),
+                    "files": info["files"],
+                    "age": round(now - info["seen"], 1),
+                }
+                for peer, info in peers
+            ],
+        }
+
+    def merge_peer_view(self, view: Dict) -> None:
+        # Remember the peers of a peer exchange message, keeping the freshest information of each peer
+        now = time.time()
+        entries = [dict(view["self"], age=0)] + view["peers"]
+        own_addr = (self.upload_ip, self.upload_socket.getsockname()[1])
+        with self.known_peers_lock:
+            for entry in entries:
+                peer = (entry["addr"][0], int(entry["addr"][1]))
+                if peer == own_addr:
+                    continue
+                seen = now - entry["age"]
+                known = self.known_peers.get(peer)
+                if known is None or known["seen"] < seen:
+                    self.known_peers[peer] = {"files": entry["files"], "seen": seen}
+            self.evict_known_peers()
+
+    def remember_holders(self, data: Dict) -> None:
+        # Remember the holders returned by the tracker so later fetches can skip it
+        now = time.time()
+        with self.known_peers_lock:
+            for file_name, file_data in data["files"].items():
+                for peer_info in file_data["peers"]:
+                    peer = (peer_info["ip_addr"], int(peer_info["upload_port"]))
+                    known = self.known_peers.setdefault(
+                        peer, {"files": {}, "seen": now}
+                    )
+                    known["files"][file_name] = {
+                        key: file_data[key]
+                        for key in ("piece_count", "version", "modified")
+                    }
+            self.evict_known_peers()
+
+    def forget_peer(self, peer: Tuple[str, int]) -> None:
+        with self.known_peers_lock:
+            self.known_peers.pop(peer, None)
+
+    def evict_known_peers(self) -> None:
+        # Drop the least recently seen peers above MAX_KNOWN_PEERS (caller holds known_peers_lock)
+        overflow = len(self.known_peers) - MAX_KNOWN_PEERS
+        if overflow <= 0:
+            return
+        oldest = sorted(
+            self.known_peers, key=lambda peer: self.known_peers[peer]["seen"]
+        )
+        for peer in oldest[:overflow]:
+            del self.known_peers[peer]
+
+    def known_holders(self, files: List[str]) -> Dict:
+        """
+        Build a fetch response, in the tracker's format, from the peers known through peer exchange
+
+        Only the holders of the newest version gossiped for a file (latest modification time)
+        are listed. The tracker is asked for the first page of holders of a file only if these
+        peers do not cover all of its pieces, hence next_offset 0.
+        """
+        data = {"files": {}, "exclude": []}
+        with self.known_peers_lock:
+            known_peers = list(self.known_peers.items())
+        random.shuffle(known_peers)
+        for peer, info in known_peers:
+            for file_name in files:
+                file_info = info["files"].get(file_name)
+                if file_info is None:
+                    continue
+                file_data = data["files"].get(file_name)
+                if file_data is None or file_info["modified"] > file_data["modified"]:
+                    file_data = data["files"][file_name] = dict(
+                        file_info, total=0, offset=0, next_offset=0, peers=[]
+                    )
+                elif file_info["version"] != file_data["version"]:
+                    continue
+                if len(file_data["peers"]) < PEERS_PAGE_SIZE:
+                    file_data["total"] += 1
+                    file_data["peers"].append(
+                        {"ip_addr": peer[0], "upload_port": peer[1]}
+                    )
+        return data
+
+    def peer_exchange(self) -> None:
+        # Periodically gossip the known peers with a few random known peers
+        while not self.stopped.wait(PEX_INTERVAL):
+            with self.known_peers_lock:
+                targets = random.sample(
+                    list(self.known_peers), min(PEX_FANOUT, len(self.known_peers))
+                )
+            for peer in targets:
+                try:
+                    with socket.socket(
+                        socket.AF_INET, socket.SOCK_STREAM
+                    ) as pex_socket:
+                        pex_socket.settimeout(REQUEST_TIMEOUT)
+                        pex_socket.connect(peer)
+                        NodeUtils.send_line(
+                            pex_socket, f"pex {json.dumps(self.peer_view())}"
+                        )
+                        view = json.loads(NodeUtils.recv_all(pex_socket).decode())
+                    self.merge_peer_view(view)
+                except Exception:
+                    self.forget_peer(peer)
 
     def request_pieces_info_from(
         self, ip_addr: str, upload_port: str, requested_files: list[str]
@@ -307,88 +1797,486 @@ class Node:
             with socket.socket(
                 socket.AF_INET, socket.SOCK_STREAM
             ) as pieces_request_socket:
+                pieces_request_socket.settimeout(REQUEST_TIMEOUT)
                 pieces_request_socket.connect((ip_addr, int(upload_port)))
-                pieces_request_socket.sendall(
-                    f"find {' '.join(requested_files)}".encode()
+                NodeUtils.send_line(
+                    pieces_request_socket, f"find {' '.join(requested_files)}"
                 )
-                data = pieces_request_socket.recv(10240).decode()
+                data = NodeUtils.recv_all(pieces_request_socket).decode()
             return json.loads(data)
         except Exception as e:
             print(
                 f"[Error]: Failed to request pieces from {ip_addr}:{upload_port} - {e}"
             )
+            self.forget_peer((ip_addr, int(upload_port)))
             return {}
 
-    def download_manager(self, request_queues: Dict[Tuple[str, int], List[str]]):
-        download_threads = []
+    def download_manager(
+        self,
+        request_queues: Dict[Tuple[str, int], List[str]],
+        compressible: set,
+        piece_locations: Dict[Tuple[str, int], Dict[str, Tuple[str, int]]],
+        handle: FetchHandle,
+    ):
+        # Download the queue of each peer in a thread of its own
+        # The pieces a peer failed to send (it left, or sent a bad piece) are queued again on
+        # the other peers offering them, a peer that failed once is not given more pieces
+        self.download_queue_depth.inc(
+            sum(len(queue) for queue in request_queues.values())
+        )
+        # Pieces asked of each peer, to spread the requeued pieces on the least loaded
+        assigned = {peer: len(queue) for peer, queue in request_queues.items()}
+        failed_peers = set()
+        finished: Queue = Queue()
+        running = 0
+
+        def start_download(peer: Tuple[str, int], queue: List[str]) -> None:
+            nonlocal running
+            running += 1
+            Thread(
+                target=lambda: finished.put(
+                    (
+                        peer,
+                        self.download(
+                            peer[0],
+                            peer[1],
+                            queue,
+                            compressible,
+                            piece_locations[peer],
+                            handle,
+                        ),
+                    )
+                ),
+            ).start()
+
         for peer, queue in request_queues.items():
-            thread = Thread(target=self.download, args=(peer[0], peer[1], queue))
-            download_threads.append(thread)
-            thread.start()
+            start_download(peer, queue)
 
-        for thread in download_threads:
-            thread.join()
+        while running:
+            peer, failed_pieces = finished.get()
+            running -= 1
+            if not failed_pieces or handle.cancelled:
+                continue
+            failed_peers.add(peer)
+            requeued: Dict[Tuple[str, int], List[str]] = {}
+            for piece_hash in failed_pieces:
+                holders = [
+                    holder
+                    for holder, locations in piece_locations.items()
+                    if holder not in failed_peers and piece_hash in locations
+                ]
+                if not holders:
+                    print(f"[Error]: No other peer offers {piece_hash[:12]}")
+                    continue
+                holder = min(holders, key=lambda holder: assigned.get(holder, 0))
+                assigned[holder] = assigned.get(holder, 0) + 1
+                requeued.setdefault(holder, []).append(piece_hash)
+            for holder, queue in requeued.items():
+                print(
+                    f"[Fetch]: {len(queue)} pieces of {peer[0]}:{peer[1]} "
+                    f"requeued on {holder[0]}:{holder[1]}"
+                )
+                # Consecutive pieces of a file stay together to be asked in batches
+                queue.sort(key=lambda piece_hash: piece_locations[holder][piece_hash])
+                self.download_queue_depth.inc(len(queue))
+                start_download(holder, queue)
 
         print("Download completed")
 
-    def download(self, target_ip: str, target_port: int, piece_queue: List[str]):
+    def download(
+        self,
+        target_ip: str,
+        target_port: int,
+        piece_queue: List[str],
+        compressible: set,
+        piece_locations: Dict[str, Tuple[str, int]],
+        handle: FetchHandle,
+    ) -> List[str]:
+        # Download the pieces of piece_queue (their hashes) into the temp folder of the fetch
+        # and keep those whose content matches, until the fetch is cancelled
+        # Return the pieces that were not received
+        # Consecutive pieces of a file (up to BATCH_PIECES) are asked in one batched request,
+        # piece_locations gives the file and the piece id of each piece on that peer
+        # Compression is asked for the compressible pieces if the node has compression on
+        peer_label = (f"{target_ip}:{target_port}",)
+        batches: List[Tuple[str, Dict[int, str]]] = []
+        for piece_hash in piece_queue:
+            file_name, piece_id = piece_locations[piece_hash]
+            if (
+                batches
+                and batches[-1][0] == file_name
+                and len(batches[-1][1]) < BATCH_PIECES
+            ):
+                batches[-1][1][piece_id] = piece_hash
+            else:
+                batches.append((file_name, {piece_id: piece_hash}))
+
+        remaining = len(piece_queue)
+        received_pieces = set()
         try:
-            for piece_name in piece_queue:
+            for file_name, batch in batches:
+                if handle.cancelled:
+                    break
+                start_time = time.perf_counter()
                 with socket.socket(
                     socket.AF_INET, socket.SOCK_STREAM
                 ) as download_socket:
+                    download_socket.settimeout(REQUEST_TIMEOUT)
                     download_socket.connect((target_ip, target_port))
-                    download_socket.sendall(f"request {piece_name}".encode())
-
-                    piece_data = b""
-                    while True:
-                        chunk = download_socket.recv(PIECE_SIZE)
-                        if not chunk:
-                            break
-                        piece_data += chunk
-
-                    if piece_data:
-                        piece_path = os.path.join(TEMP_FOLDER, f"{piece_name}")
-                        with open(piece_path, "wb") as piece_file:
-                            piece_file.write(piece_data)
-                    else:
-                        print(
-                            f"[Error]: Failed to download {piece_name}, no data received"
-                        )
-                        continue
+                    self.connect_time.observe(time.perf_counter() - start_time)
+                    compress = bool(self.compression) and any(
+                        piece_hash in compressible for piece_hash in batch.values()
+                    )
+                    NodeUtils.send_line(
+                        download_socket,
+                        f"request {file_name} {NodeUtils.format_piece_ids(batch)}"
+                        + (
+                            f" --compress={','.join(self.compression)}"
+                            if compress
+                            else ""
+                        ),
+                    )
+
+                    # Stream each framed piece to its temp file through a pooled buffer
+                    with (
+                        download_socket.makefile("rb") as reader,
+                        self.buffer_pool.buffer() as buffer,
+                    ):
+                        while not handle.cancelled:
+                            header = NodeUtils.recv_line(reader)
+                            if header is None:
+                                break
+                            piece_id, _, codec, length = header.split()
+                            piece_hash = batch.pop(int(piece_id))
+                            remaining -= 1
+                            self.download_queue_depth.dec()
+                            received = self.receive_piece(
+                                reader,
+                                buffer,
+                                piece_hash,
+                                codec,
+                                int(length),
+                                handle.temp_folder,
+                            )
+                            if received:
+                                received_pieces.add(piece_hash)
+                                handle.add_piece(received)
+                                self.downloaded_bytes.inc(received, peer_label)
+                                self.piece_download_time.observe(
+                                    time.perf_counter() - start_time
+                                )
+                            start_time = time.perf_counter()
+
+                for piece_hash in [] if handle.cancelled else batch.values():
+                    print(f"[Error]: Failed to download {piece_hash[:12]}, not sent")
 
         except Exception as e:
             print(f"[Error]: Unexpected error during download: {e}")
+        finally:
+            # Pieces left in the queue after an error are not waiting anymore
+            self.download_queue_depth.dec(remaining)
+        return [
+            piece_hash
+            for piece_hash in piece_queue
+            if piece_hash not in received_pieces
+        ]
+
+    def receive_piece(
+        self,
+        reader,
+        buffer: memoryview,
+        piece_hash: str,
+        codec: str,
+        length: int,
+        temp_folder: str = TEMP_FOLDER,
+    ) -> int:
+        # Read the length bytes of a framed piece, decompressed with codec, into its file in
+        # temp_folder and return the bytes received, 0 if the content does not match piece_hash
+        if codec not in ("raw",) + CODECS:
+            raise ValueError(f"unknown codec {codec}")
+        # A piece is never larger than PIECE_SIZE, a body decompressing to more fails
+        decompressor = (
+            None if codec == "raw" else BoundedDecompressor(codec, PIECE_SIZE)
+        )
+        piece_path = NodeUtils.piece_path(piece_hash, temp_folder)
+        received = 0
+        digest = hashlib.sha256()
+        error = "hash mismatch"
+        with open(piece_path, "wb") as piece_file:
+            while received < length:
+                count = reader.readinto(buffer[: min(len(buffer), length - received)])
+                if not count:
+                    break
+                received += count
+                if digest is None:
+                    # The rest of the body is skipped to reach the next framed piece
+                    continue
+                data = buffer[:count]
+                try:
+                    if decompressor is not None:
+                        data = decompressor.decompress(data)
+                except ValueError as e:
+                    error, digest = str(e), None
+                    continue
+                piece_file.write(data)
+                digest.update(data)
+            if decompressor is not None and digest is not None:
+                try:
+                    data = decompressor.flush()
+                    piece_file.write(data)
+                    digest.update(data)
+                except ValueError as e:
+                    error, digest = str(e), None
+
+        if (
+            received == length
+            and digest is not None
+            and digest.hexdigest() == piece_hash
+        ):
+            return received
+        os.remove(piece_path)
+        print(
+            f"[Error]: Failed to download {piece_hash[:12]}, "
+            + (error if received == length else "connection closed")
+        )
+        if received < length:
+            raise ConnectionError("connection closed in the middle of a piece")
+        return 0
+
+    def pin_pieces(self, piece_hashes: set) -> None:
+        # Keep pieces of the store for a running fetch (combine_lock held)
+        for piece_hash in piece_hashes:
+            self.pinned_pieces[piece_hash] = self.pinned_pieces.get(piece_hash, 0) + 1
+
+    def unpin_pieces(self, piece_hashes: set) -> None:
+        # Release pieces kept for a fetch, removing those no file uses (combine_lock held)
+        unpinned = set()
+        for piece_hash in piece_hashes:
+            self.pinned_pieces[piece_hash] -= 1
+            if not self.pinned_pieces[piece_hash]:
+                del self.pinned_pieces[piece_hash]
+                unpinned.add(piece_hash)
+        for piece_hash in unpinned - self.pieces.referenced(unpinned):
+            try:
+                os.unlink(NodeUtils.piece_path(piece_hash))
+            except FileNotFoundError:
+                pass
+
+    def combine_pieces(
+        self,
+        requested_files: List[str],
+        manifests: Dict[str, List[str]],
+        modified_times: Dict[str, float] = None,
+        temp_folder: str = TEMP_FOLDER,
+    ) -> List[str]:
+        """
+        Write the requested files from their pieces and return the files that were combined
+
+        The downloaded pieces are moved from temp_folder to the piece store, so they are
+        shared with every other file of the node that has the same content. A file the node
+        already has (an older version) is patched in place: only the pieces whose hash
+        changed are written, and its pieces that no file uses anymore leave the store.
+
+        Args:
+            - requested_files (List[str]): files to combine
+            - manifests (Dict[str, List[str]]): hashes of the pieces of each file, in piece order
+            - modified_times (Dict[str, float]): modification time of the version of each file
+            - temp_folder (str): folder of the downloaded pieces
+        """
+        modified_times = modified_times or {}
+        for piece_hash in os.listdir(temp_folder):
+            if NodeUtils.is_piece_hash(piece_hash):
+                os.replace(
+                    NodeUtils.piece_path(piece_hash, temp_folder),
+                    NodeUtils.piece_path(piece_hash),
+                )
 
-    def combine_pieces(self, requested_files: List[str]) -> None:
+        combined_files = []
         for file_name in requested_files:
+            manifest = manifests[file_name]
+            missing = [
+                piece_hash
+                for piece_hash in manifest
+                if not os.path.exists(NodeUtils.piece_path(piece_hash))
+            ]
+            if missing:
+                print(f"[Error]: {len(missing)} pieces of file {file_name} are missing")
+                continue
             combined_file_path = os.path.join(REPO_FOLDER, file_name)
-            with open(combined_file_path, "wb") as combined_file:
-                piece_prefix = f"{file_name.split('.')[0]}_"  # e.g "1MB_"
-                pieces = sorted(
-                    [f for f in os.listdir(TEMP_FOLDER) if f.startswith(piece_prefix)],
-                    key=lambda x: int(x.split("_")[1].split(".")[0]),
+            old_hashes = self.pieces.hashes_of(file_name)
+            file_size = 0
+            if manifest:
+                file_size = (len(manifest) - 1) * PIECE_SIZE + os.path.getsize(
+                    NodeUtils.piece_path(manifest[-1])
                 )
-                if len(pieces) == 0:
-                    continue
-                for piece in pieces:
-                    piece_path = os.path.join(TEMP_FOLDER, piece)
-                    with open(piece_path, "rb") as piece_file:
-                        with mmap.mmap(
-                            piece_file.fileno(), length=0, access=mmap.ACCESS_READ
-                        ) as mmapped_file:
-                            combined_file.write(mmapped_file)
+            with (
+                open(
+                    combined_file_path, "r+b" if old_hashes else "wb"
+                ) as combined_file,
+                self.buffer_pool.buffer() as buffer,
+            ):
+                for piece_id, piece_hash in enumerate(manifest):
+                    if (
+                        piece_id < len(old_hashes)
+                        and old_hashes[piece_id] == piece_hash
+                    ):
+                        continue
+                    combined_file.seek(piece_id * PIECE_SIZE)
+                    with open(NodeUtils.piece_path(piece_hash), "rb") as piece_file:
+                        NodeUtils.copy_stream(piece_file, combined_file, buffer)
+                combined_file.truncate(file_size)
+            if file_name in modified_times:
+                os.utime(
+                    combined_file_path,
+                    (modified_times[file_name], modified_times[file_name]),
+                )
+            self.pieces.add_file(
+                file_name,
+                file_size,
+                b"".join(bytes.fromhex(piece_hash) for piece_hash in manifest),
+            )
+
+            if old_hashes:
+                stale_hashes = set(old_hashes) - set(manifest)
+                for piece_hash in stale_hashes - self.pieces.referenced(stale_hashes):
+                    if piece_hash not in self.pinned_pieces:
+                        os.unlink(NodeUtils.piece_path(piece_hash))
+                changed = sum(
+                    1
+                    for piece_id, piece_hash in enumerate(manifest)
+                    if piece_id >= len(old_hashes) or old_hashes[piece_id] != piece_hash
+                )
+                print(
+                    f"[Update]: Patched {changed}/{len(manifest)} pieces of {file_name}"
+                )
+            combined_files.append(file_name)
+        return combined_files
 
     def discover(self):
-        self.tracker_send_socket.send("discover".encode())
-        received_data = self.tracker_send_socket.recv(1024).decode()
-        print(received_data)
+        # List the whole catalog by paging through every tracker shard
+        files = set()
+        for shard, tracker in self.trackers.items():
+            offset = 0
+            while tracker.alive and offset is not None:
+                try:
+                    response = json.loads(
+                        tracker.request(
+                            f"discover --offset={offset} --limit={SEARCH_PAGE_SIZE}"
+                        )
+                    )
+                except Exception as e:
+                    print(f"[Error]: Tracker {shard} failed: {e}")
+                    break
+                files.update(response["results"])
+                offset = response["next_offset"]
+        print(json.dumps(sorted(files)))
+
+    def search(self, message: str) -> None:
+        """
+        Search the catalog of every tracker shard and print one page of the matching file names
+
+        Args:
+            - message (str): search [--prefix|--glob|--substring] <query> [--offset=N] [--limit=N]
+        """
+        mode, offset, limit, query = "substring", 0, SEARCH_PAGE_SIZE, []
+        for arg in message.split()[1:]:
+            if arg in ("--prefix", "--glob", "--substring"):
+                mode = arg[2:]
+            elif arg.startswith("--offset="):
+                offset = int(arg.split("=", 1)[1])
+            elif arg.startswith("--limit="):
+                limit = int(arg.split("=", 1)[1])
+            else:
+                query.append(arg)
+        if not query:
+            print("[Warning]: Usage: search [--prefix|--glob|--substring] <query>")
+            return
+
+        request = f"search {mode} {' '.join(query)}"
+        shards = [shard for shard, tracker in self.trackers.items() if tracker.alive]
+        copies = min(self.replicas, len(self.ring.shards))
+        try:
+            if copies == len(self.ring.shards):
+                # Every shard lists every file, the page is asked from the first one that
+                # answers
+                for shard in shards:
+                    try:
+                        total, page = self.search_pages(shard, request, offset, limit)
+                        break
+                    except ConnectionError as e:
+                        print(f"[Error]: Tracker {shard} failed: {e}")
+                else:
+                    total, page = 0, []
+            else:
+                # A file is listed by its owner shard and its replicas, so the page is cut
+                # from the merge of the first offset + limit matches of every shard
+                total = 0
+                complete = True
+                files = set()
+                for shard in shards:
+                    try:
+                        shard_total, names = self.search_pages(
+                            shard, request, 0, offset + limit
+                        )
+                    except ConnectionError as e:
+                        print(f"[Error]: Tracker {shard} failed: {e}")
+                        continue
+                    total += shard_total
+                    complete = complete and shard_total == len(names)
+                    files.update(names)
+                # The merged matches give the total when no shard left any out,
+                # otherwise every match is counted once per shard listing it
+                if complete:
+                    total = len(files)
+                else:
+                    total = max(len(files), round(total / copies))
+                page = sorted(files)[offset : offset + limit]
+        except ValueError as e:
+            print(f"[Error]: {e}")
+            return
+        print(json.dumps(page, indent=2))
+        print(
+            f"[Result]: {offset + 1 if page else offset}-{offset + len(page)} of {total}"
+        )
+
+    def search_pages(
+        self, shard: str, request: str, offset: int, count: int
+    ) -> Tuple[int, List[str]]:
+        # Total matches of a search on a tracker shard and its count matches from offset on,
+        # paged through as the shard caps the size of a page
+        # ValueError if the shard rejects the search, ConnectionError if it fails
+        tracker = self.trackers[shard]
+        names: List[str] = []
+        total = 0
+        next_offset = offset
+        while next_offset is not None and len(names) < count:
+            try:
+                response = json.loads(
+                    tracker.request(
+                        f"{request} --offset={next_offset} --limit={count - len(names)}"
+                    )
+                )
+            except OSError as e:
+                raise ConnectionError(str(e)) from e
+            if "error" in response:
+                raise ValueError(response["error"])
+            total = response["total"]
+            names.extend(response["results"])
+            next_offset = response["next_offset"]
+        return total, names
 
     def node_command_shell(self) -> None:
         # Node command shell for user to interact with the node
+        # A fetch runs in the background, jobs/watch show its progress and cancel stops it
+        # When the input ends (e.g the node runs in the background), the node keeps serving
         while True:
-            sock_name, sock_port = self.tracker_send_socket.getsockname()
-            cmd_input = input(f"{sock_name}:{sock_port} ~ ")
+            sock_name, sock_port = self.upload_socket.getsockname()
+            try:
+                cmd_input = input(f"{sock_name}:{sock_port} ~ ")
+            except EOFError:
+                print("\n[Node]: No more commands, serving until interrupted")
+                self.stopped.wait()
+                return
             cmd_parts = cmd_input.split()
 
             if not cmd_parts:
@@ -399,91 +2287,265 @@ class Node:
                     for piece in self.pieces:
                         print(piece)
                 case "fetch":
-                    self.fetch(cmd_input)
+                    if len(cmd_parts) == 1:
+                        print("Usage: fetch [files]")
+                        continue
+                    handle = self.fetch_async(cmd_parts[1:])
+                    print(f"[Fetch]: Started fetch {handle.fetch_id}")
+                case "jobs":
+                    for handle in list(self.fetches.values()):
+                        print(handle)
+                case "cancel":
+                    for handle in self.select_fetches(cmd_parts[1:]):
+                        handle.cancel()
+                case "wait":
+                    try:
+                        for handle in self.select_fetches(cmd_parts[1:]):
+                            handle.wait()
+                    except KeyboardInterrupt:
+                        print()
+                case "watch":
+                    self.watch_fetches(self.select_fetches(cmd_parts[1:]))
                 case "discover":
                     self.discover()
+                case "search":
+                    self.search(cmd_input)
+                case "stats":
+                    print(self.metrics.summary())
                 case "exit":
                     self.close()
                 case _:
                     print("Unknown command")
 
+    def select_fetches(self, fetch_ids: List[str]) -> List[FetchHandle]:
+        # Fetches of the given ids, or every running fetch if no id is given
+        if not fetch_ids:
+            return [handle for handle in list(self.fetches.values()) if not handle.done]
+        handles = []
+        for fetch_id in fetch_ids:
+            handle = self.fetches.get(int(fetch_id)) if fetch_id.isdigit() else None
+            if handle is None:
+                print(f"[Warning]: No fetch {fetch_id}")
+            else:
+                handles.append(handle)
+        return handles
+
+    def watch_fetches(self, handles: List[FetchHandle]) -> None:
+        # Print the progress and the current throughput of the fetches every WATCH_INTERVAL
+        # seconds until they end, Ctrl+C goes back to the shell
+        received = {handle.fetch_id: handle.received_bytes for handle in handles}
+        try:
+            while handles:
+                if not all(handle.done for handle in handles):
+                    time.sleep(WATCH_INTERVAL)
+                for handle in handles:
+                    rate = (handle.received_bytes - received[handle.fetch_id]) / (
+                        WATCH_INTERVAL * 2**20
+                    )
+                    received[handle.fetch_id] = handle.received_bytes
+                    print(
+                        f"{handle}" + ("" if handle.done else f", now {rate:.2f} MB/s")
+                    )
+                if all(handle.done for handle in handles):
+                    break
+        except KeyboardInterrupt:
+            print()
+
     def close_sockets(self):
         # Closed all the sockets
-        self.tracker_send_socket.close()
+        for tracker in self.trackers.values():
+            tracker.close()
         self.upload_socket.close()
 
-    def close(self):
-        # Close the node by sending the close message to the tracker and remove all the pieces
+    def stop(self) -> None:
+        # Leave the network without exiting: tell the trackers, cancel the fetches, stop
+        # serving and remove all the pieces
+        self.stopped.set()
+        for handle in self.fetches.values():
+            handle.cancel()
         try:
-            self.tracker_send_socket.settimeout(REQUEST_TIMEOUT)
-            self.tracker_send_socket.sendall("close".encode())
+            for tracker in self.trackers.values():
+                if not tracker.alive:
+                    continue
+                tracker.send("close")
         except Exception as e:
             print(f"[Error]: Failed to send close message to tracker: {e}")
         finally:
             self.close_sockets()
+            if self.metrics_server is not None:
+                self.metrics_server.close()
             for filename in os.listdir(PIECES_FOLDER):
                 os.unlink(os.path.join(PIECES_FOLDER, filename))
-            for filename in os.listdir(TEMP_FOLDER):
-                os.unlink(os.path.join(TEMP_FOLDER, filename))
-            os._exit(0)
+            shutil.rmtree(TEMP_FOLDER, ignore_errors=True)
+            os.makedirs(TEMP_FOLDER, exist_ok=True)
+
+    def close(self):
+        # Close the node by sending the close message to the tracker and remove all the pieces
+        self.stop()
+        os._exit(0)
 
 
 class NodeUtils:
+    @staticmethod
+    def send_line(sock: socket.socket, msg: str) -> None:
+        # Send a single newline-terminated message
+        sock.sendall(f"{msg}\n".encode())
+
+    @staticmethod
+    def recv_line(reader) -> str | None:
+        # Read a single newline-terminated message, None if the connection is closed
+        line = reader.readline()
+        if not line:
+            return None
+        return line.decode().rstrip("\r\n")
+
+    @staticmethod
+    def recv_all(sock: socket.socket) -> bytes:
+        # Read until the other side closes the connection
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
     @staticmethod
     def generate_pieces_from_repo_files(
         folder_name: str = None,
         file_list: str = None,
         piece_size: int = PIECE_SIZE,
-    ) -> List[Piece]:
-        # Generate Piece based on folder_name/{file_list}
-        # If file_list is None, generate Piece of all files in folder_name
+        piece_table: PieceTable = None,
+        buffer_pool: BufferPool = None,
+    ) -> PieceTable:
+        # Generate pieces based on folder_name/{file_list} and record them in piece_table
+        # If file_list is None, generate pieces of all files in folder_name
+        # If piece_table is None, a new PieceTable is returned
+        # The files are copied through a single buffer of buffer_pool (or a private one)
 
         file_names = file_list if file_list is not None else os.listdir(folder_name)
 
-        pieces = []
+        pieces = piece_table if piece_table is not None else PieceTable(piece_size)
+        buffer_pool = buffer_pool or BufferPool(STREAM_BUFFER_SIZE)
+
+        with buffer_pool.buffer() as buffer:
+            for file_name in file_names:
+                file_path = os.path.join(folder_name, file_name)
+                piece_hashes = bytearray()
+                with open(file_path, "rb") as file:
+                    file_size = os.fstat(file.fileno()).st_size
+                    for _ in range(math.ceil(file_size / piece_size)):
+                        # Write the piece under a unique temporary name while hashing it, then
+                        # store it under its hash unless a piece with the same content exists
+                        digest = hashlib.sha256()
+                        with tempfile.NamedTemporaryFile(
+                            dir=PIECES_FOLDER, prefix=".", delete=False
+                        ) as piece_file:
+                            NodeUtils.copy_stream(
+                                file, piece_file, buffer, piece_size, digest
+                            )
+                        piece_path = NodeUtils.piece_path(digest.hexdigest())
+                        if os.path.exists(piece_path):
+                            os.unlink(piece_file.name)
+                        else:
+                            os.replace(piece_file.name, piece_path)
+                        piece_hashes += digest.digest()
+                pieces.add_file(file_name, file_size, bytes(piece_hashes))
+        return pieces
 
-        for file_name in file_names:
-            piece_id = 0
-            file_path = os.path.join(folder_name, file_name)
-            with open(file_path, "r+b") as file:
-                mmap_obj = mmap.mmap(file.fileno(), length=0, access=mmap.ACCESS_READ)
-                while True:
-                    # Start sliding window
-                    start_index = piece_id * piece_size
-                    end_index = start_index + piece_size
-                    piece_sliding_window = mmap_obj[start_index:end_index]
-
-                    # End sliding window
-                    if not piece_sliding_window:
-                        break
+    @staticmethod
+    def copy_stream(
+        source, destination, buffer: memoryview, count: int = None, digest=None
+    ) -> int:
+        # Copy count bytes (or up to EOF) from source to destination through buffer
+        # If digest is given, it is updated with the copied bytes
+        copied = 0
+        while count is None or copied < count:
+            size = len(buffer) if count is None else min(len(buffer), count - copied)
+            read = source.readinto(buffer[:size])
+            if not read:
+                break
+            destination.write(buffer[:read])
+            if digest is not None:
+                digest.update(buffer[:read])
+            copied += read
+        return copied
+
+    @staticmethod
+    def compressor(codec: str):
+        # Streaming compressor (compress/flush) of a codec of CODECS
+        if codec == "zstd":
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return zlib.compressobj(ZLIB_LEVEL)
+
+    @staticmethod
+    def sample_size(sample: memoryview) -> int:
+        # Size of a sample compressed at the fastest level, the output is counted and dropped
+        sampler = zlib.compressobj(
+            1, zlib.DEFLATED, SAMPLE_WINDOW_BITS, SAMPLE_MEM_LEVEL
+        )
+        size = 0
+        for start in range(0, len(sample), SAMPLE_CHUNK_SIZE):
+            size += len(sampler.compress(sample[start : start + SAMPLE_CHUNK_SIZE]))
+        return size + len(sampler.flush())
 
-                    # Create a new piece file
-                    piece_name = f"{os.path.basename(file_name).split('.')[0]}_{piece_id}.{os.path.basename(file_name).split('.')[1]}"
+    @staticmethod
+    def map_file(path: str, size: int) -> mmap.mmap:
+        # Copy of a file of size bytes in anonymous memory of its own, given back to the system
+        # as soon as it is no longer referenced (freed heap memory may stay in the process)
+        buffer = mmap.mmap(-1, size)
+        with open(path, "rb") as file:
+            file.readinto(buffer)
+        return buffer
 
-                    piece_path = f"{PIECES_FOLDER}/{piece_name}"
-                    with open(piece_path, "wb") as piece_file:
-                        piece_file.write(piece_sliding_window)
+    @staticmethod
+    def format_piece_ids(piece_ids) -> str:
+        # Ranges of consecutive piece ids and single ids, e.g [1, 2, 3, 7] -> "1-3,7"
+        parts = []
+        for piece_id in sorted(piece_ids):
+            if parts and parts[-1][1] == piece_id - 1:
+                parts[-1][1] = piece_id
+            else:
+                parts.append([piece_id, piece_id])
+        return ",".join(
+            str(first) if first == last else f"{first}-{last}" for first, last in parts
+        )
 
-                    # Create a new Piece object
-                    piece = Piece(
-                        piece_id=piece_id,
-                        original_filename=file_name,
-                        start_index=start_index,
-                        end_index=end_index,
-                    )
-                    pieces.append(piece)
-                    piece_id += 1
-                mmap_obj.close()
-        return pieces
+    @staticmethod
+    def parse_piece_ids(piece_ids: str, piece_count: int) -> List[int]:
+        # Piece ids of a string made by format_piece_ids, ids out of [0, piece_count) are dropped
+        result = []
+        for part in piece_ids.split(","):
+            first, _, last = part.partition("-")
+            if not first.isdigit() or not (last or first).isdigit():
+                continue
+            result.extend(
+                range(int(first), min(int(last or first), piece_count - 1) + 1)
+            )
+        return result
+
+    @staticmethod
+    def is_piece_hash(name: str) -> bool:
+        # Piece names are the hex sha256 of their content, anything else is not a piece
+        return len(name) == 2 * PIECE_HASH_SIZE and all(
+            char in "0123456789abcdef" for char in name
+        )
+
+    @staticmethod
+    def piece_path(piece_hash: str, folder_name: str = PIECES_FOLDER) -> str:
+        return os.path.join(folder_name, piece_hash)
 
     @staticmethod
     def generate_files_info_from(
         folder_name: str = None,
         file_names: List[str] = None,
         piece_size: int = 512 * 1024,
+        piece_table: PieceTable = None,
     ) -> str:
         # Generate file info from folder_name/[file_names].txt
         # If file_name is None, generate file infos from all files in folder_name
+        # If piece_table is given, the info of its files also has the version id, the
+        # modification time and the piece hashes announced to the tracker
 
         file_info = {}
         file_names = file_names if file_names is not None else os.listdir(folder_name)
@@ -498,18 +2560,71 @@ class NodeUtils:
                 "piece_size": piece_size,
                 "piece_count": piece_count,
             }
+            if piece_table is not None and file_name in piece_table:
+                file_info[file_name].update(
+                    version=piece_table.version(file_name),
+                    modified=os.path.getmtime(file_path),
+                    piece_hashes=piece_table.hashes_of(file_name),
+                )
 
         return json.dumps(file_info)
 
     @staticmethod
-    def get_request_queue(
+    def pieces_covered(
         filename: str,
+        piece_count: int,
         request_obj: Dict[Tuple[str, int], Dict[str, List[str]]],
-        curr_pieces_info: Dict[str, List[str]],
+    ) -> bool:
+        # Check whether one of the queried peers listed every piece of filename
+        return any(
+            len(pieces_info.get(filename, [])) >= piece_count
+            for pieces_info in request_obj.values()
+        )
+
+    @staticmethod
+    def choose_manifests(
+        requested_files: List[str],
+        request_obj: Dict[Tuple[str, int], Dict[str, List[str]]],
+        known: Dict[str, List[str]] = None,
+        versions: Dict[str, str] = None,
+    ) -> Dict[str, List[str]]:
+        # Pick for each file the piece hashes given by the tracker (known) or else listed by
+        # most peers (among those listing the wanted version, if given), peers listing other
+        # hashes (another version of the file) are not downloaded from for that file
+        versions = versions or {}
+        manifests = {}
+        for filename in requested_files:
+            if known and filename in known:
+                manifests[filename] = known[filename]
+                continue
+            votes: Dict[Tuple[str, ...], int] = {}
+            for pieces_info in request_obj.values():
+                if pieces_info.get(filename):
+                    manifest = tuple(pieces_info[filename])
+                    if versions.get(filename) and (
+                        NodeUtils.manifest_version(manifest) != versions[filename]
+                    ):
+                        continue
+                    votes[manifest] = votes.get(manifest, 0) + 1
+            if votes:
+                manifests[filename] = list(max(votes, key=votes.get))
+        return manifests
+
+    @staticmethod
+    def manifest_version(piece_hashes: List[str]) -> str:
+        # Version id of the file made of these pieces, as PieceTable.version computes it
+        return hashlib.sha256(
+            b"".join(bytes.fromhex(piece_hash) for piece_hash in piece_hashes)
+        ).hexdigest()
+
+    @staticmethod
+    def get_request_queue(
+        request_obj: Dict[Tuple[str, int], List[str]],
+        missing_pieces: set,
     ) -> Dict[tuple[str, int], List[str]]:
-        def create_request_queue(
-            filename: str, file_extension: str, data: dict[int, list[str]]
-        ):
+        # Spread the missing pieces (their hashes) over the peers offering them, every piece
+        # goes to a single peer and the peers with the fewest pieces are served first
+        def create_request_queue(data: dict[Tuple[str, int], list[str]]):
 
             # return key whose value has the minimum length
             def get_min_key(d, keys):
@@ -527,16 +2642,18 @@ class NodeUtils:
             # Get the request queue
             result = {key: [] for key in data}
             keys = list(data.keys())
-            total_value = 0
-            for value in data.values():
-                total_value += len(value)
-            while total_value > 0:
+            assigned = set()
+            while keys:
                 listkey = keys.copy()
 
                 # Loop through remaining keys(node's port) to update correspond request queue
                 while len(listkey) > 0:
                     min_key = get_min_key(data, listkey)
 
+                    # Skip the pieces already assigned to another peer
+                    while data[min_key] and data[min_key][-1] in assigned:
+                        data[min_key].pop()
+
                     # Remove key whose value is an empty list
                     if len(data[min_key]) == 0:
                         keys.remove(min_key)
@@ -544,46 +2661,26 @@ class NodeUtils:
                         continue
 
                     # Append request queue of corresponding node
-                    piece = data[min_key][0]
-                    piece_name = f"{filename}_{piece}.{file_extension}"
-                    result[min_key].append(piece_name)
-
-                    # remove ${piece} in each of keys'value (if any) and decrease total_value
-                    for eachkey in keys:
-                        if piece in data[eachkey]:
-                            data[eachkey].remove(piece)
-                            total_value -= 1
+                    piece = data[min_key].pop()
+                    result[min_key].append(piece)
+                    assigned.add(piece)
                     listkey.remove(min_key)
-            return result
-
-        # Initialize dictionary in which keys are nodes address
-        # and assign value with the list of pieces derived from ${filename} each nodes possesses
-        data = {key: [] for key in request_obj}
-        for key in list(request_obj.keys()):
-            value = request_obj[key]
-            if not value.get(filename):
-                del data[key]
-                continue
-            data[key] = value[filename]
-
-        # remove pieces in nodes that client already possesses (if any)
-        if curr_pieces_info.get(filename):
-            for key in list(data.keys()):
-                duplicate_piece = curr_pieces_info.get(filename)
-                for value in duplicate_piece:
-                    if value in data[key]:
-                        data[key].remove(value)
-
-        # get request_queue for each node
-        request_queue = {key: [] for key in data}
-        file_name = filename.split(".")[0]
-        file_extension = filename.split(".")[1]
-        request_queue = create_request_queue(file_name, file_extension, data)
+            return {key: queue for key, queue in result.items() if queue}
+
+        # Keep the pieces each peer offers that are missing, in reverse order so the
+        # first pieces of the files are popped first
+        data = {}
+        for key, pieces in request_obj.items():
+            offered = [
+                piece for piece in dict.fromkeys(pieces) if piece in missing_pieces
+            ]
+            if offered:
+                data[key] = offered[::-1]
 
-        return request_queue
+        return create_request_queue(data)
 
     @staticmethod
-    def cli_parser() -> Tuple[str, int]:
+    def cli_parser() -> argparse.Namespace:
         # Command line parser for Node
         parser = argparse.ArgumentParser(
             prog="Node", description="Init the Node for file system"
@@ -599,8 +2696,68 @@ class NodeUtils:
             type=int,
             help="Port number of the tracker (default: 8000)",
         )
+        parser.add_argument(
+            "--cluster",
+            default=None,
+            help="Comma separated ip:port of every tracker shard, overrides --host/--port",
+        )
+        parser.add_argument(
+            "--replicas",
+            default=1,
+            type=int,
+            help="Number of tracker shards each file is announced to (default: 1)",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            default=None,
+            type=int,
+            help="Serve Prometheus metrics on 127.0.0.1:<port>/metrics (default: off)",
+        )
+        parser.add_argument(
+            "--upload-ip",
+            default=None,
+            help="IP address the upload socket binds to (default: IP of the default route)",
+        )
+        parser.add_argument(
+            "--upload-rate",
+            default=None,
+            type=int,
+            help="Maximum upload bandwidth in bytes per second (default: unlimited)",
+        )
+        parser.add_argument(
+            "--compression",
+            default="off",
+            choices=("off", "auto") + CODECS,
+            help="Ask peers to compress the pieces of compressible files, auto picks the best codec (default: off)",
+        )
+        parser.add_argument(
+            "--compression-cache",
+            default=COMPRESSION_CACHE,
+            type=int,
+            help=f"Bytes of compressed pieces kept for other requesters (default: {COMPRESSION_CACHE})",
+        )
+        parser.add_argument(
+            "--piece-cache",
+            default=PIECE_CACHE,
+            type=int,
+            help=f"Bytes of recently uploaded pieces kept in memory, 0 to disable (default: {PIECE_CACHE})",
+        )
+        parser.add_argument(
+            "--buffer-memory",
+            default=BUFFER_MEMORY,
+            type=int,
+            help=f"Maximum bytes of buffers holding file data (default: {BUFFER_MEMORY})",
+        )
         args = parser.parse_args()
-        return (args.host, args.port)
+        args.cluster = (
+            [
+                (address.rsplit(":", 1)[0], int(address.rsplit(":", 1)[1]))
+                for address in args.cluster.split(",")
+            ]
+            if args.cluster
+            else None
+        )
+        return args
 
     @staticmethod
     def get_host_default_ip() -> str:
@@ -616,9 +2773,21 @@ class NodeUtils:
 
 
 def main() -> None:
-    tracker_ip, tracker_port = NodeUtils.cli_parser()
-    node_ip = NodeUtils.get_host_default_ip()
-    node = Node(tracker_ip, tracker_port, node_ip)
+    args = NodeUtils.cli_parser()
+    node_ip = args.upload_ip or NodeUtils.get_host_default_ip()
+    node = Node(
+        args.host,
+        args.port,
+        node_ip,
+        args.cluster,
+        args.replicas,
+        args.metrics_port,
+        args.upload_rate,
+        args.buffer_memory,
+        args.compression,
+        args.compression_cache,
+        args.piece_cache,
+    )
     try:
         node.start()
     except KeyboardInterrupt:
@@ -23,6 +23,6 @@ def remove_socket(sock: socket.socket) -> None:
 
 
 def log(node_id: int, content: str) -> None:
-    current_time = datetime.Now().strftime("%H:%M:%S")
+    current_time = datetime.datetime.now().strftime("%H:%M:%S")
     log_content = f"[{current_time}] Node {node_id}: {content}\n"
     print(log_content)
@@ -2,14 +2,36 @@
 # Date modified: Thursday 21st Nov 2024
 
 import socket
-from threading import Thread
-from typing import Dict, Tuple
+from threading import Event, Thread, Lock, current_thread
+from typing import Dict, List, Tuple
 import argparse
+import bisect
+import fnmatch
+import heapq
 import json
-import socket
+import os
+import re
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.metrics import MetricsRegistry, MetricsServer
 
 BUFFER_SIZE = 1024
 REQUEST_TIMEOUT = 3
+HANDSHAKE_TIMEOUT = 10  # Seconds a new connection has to send its handshake
+PEERS_PER_FILE = 20  # Default number of peers returned per file in a fetch response
+MAX_PEERS_PER_FILE = 200  # Upper bound of the page size a node may ask for
+SEARCH_PAGE_SIZE = 100  # Default number of file names returned by discover/search
+MAX_SEARCH_PAGE_SIZE = 1000  # Upper bound of the page size of discover/search
+CATALOG_BUCKET_SIZE = 1000  # Number of names per bucket of the catalog index
+PEER_TTL = 30  # Seconds without any message after which a peer is considered dead
+EXPIRE_CHECK_INTERVAL = 1  # Seconds between two checks of the expiry heap
+COMMANDS = ("heartbeat", "fetch", "close", "publish", "discover", "search")
+
+# Handler threads of different peers update metainfo.json concurrently
+metainfo_lock = Lock()
 
 
 class Peer:
@@ -28,6 +50,8 @@ class Peer:
         self.peer_upload_port = peer_upload_port
         self.peer_thread = peer_thread
         self.file_info = file_info
+        # Time (time.monotonic) after which the peer is expired unless it sends a message
+        self.expires_at = time.monotonic() + PEER_TTL
 
     def __str__(self) -> str:
         return (
@@ -39,30 +63,207 @@ class Peer:
 
     def close(self):
         # Close the peer connection and remove the peer from the metadata file
+        try:
+            # Wake up the handler thread blocked on reading this socket
+            self.peer_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.peer_socket.close()
-        with open("metainfo.json", "r+") as meta_file:
+        with metainfo_lock, open("metainfo.json", "r+") as meta_file:
             meta_info = json.load(meta_file)
+            node_address = f"{self.ip_address}:{self.peer_listening_port}"
             for file_name in list(self.file_info.keys()):
                 if file_name in meta_info:
-                    node_address = f"{self.ip_address}:{self.peer_listening_port}"
-                    if node_address in meta_info[file_name]["nodes"]:
-                        meta_info[file_name]["nodes"].remove(node_address)
-
-                    if len(meta_info[file_name]["nodes"]) == 0:
-                        del meta_info[file_name]
+                    TrackerUtil.remove_metainfo_node(meta_info, file_name, node_address)
 
             meta_file.seek(0)
             json.dump(meta_info, meta_file, indent=3)
             meta_file.truncate()
 
 
+class CatalogIndex:
+    """In-memory sorted index of the file names held by the live peers
+
+    Names are kept in sorted buckets of at most 2 * CATALOG_BUCKET_SIZE names, so an
+    insert or a removal only shifts one small list. Prefix queries are binary searches
+    and a slice. Substring and glob queries run str.find over a newline-joined copy of
+    the names of each bucket, so a search never touches metainfo.json or loops over every
+    name, and a change only rejoins the names of its bucket.
+    """
+
+    def __init__(self) -> None:
+        self.buckets: List[List[str]] = []
+        self.maxes: List[str] = []  # Last (largest) name of each bucket
+        self.size = 0
+        # "\n".join(bucket) of each bucket, rebuilt lazily after a change of the bucket
+        self._blobs: List[str | None] = []
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, name: str) -> None:
+        if not self.buckets:
+            self.buckets.append([name])
+            self.maxes.append(name)
+            self._blobs.append(None)
+            self.size = 1
+            return
+
+        index = min(bisect.bisect_left(self.maxes, name), len(self.maxes) - 1)
+        bucket = self.buckets[index]
+        position = bisect.bisect_left(bucket, name)
+        if position < len(bucket) and bucket[position] == name:
+            return
+        bucket.insert(position, name)
+        self.maxes[index] = bucket[-1]
+        self.size += 1
+        self._blobs[index] = None
+
+        if len(bucket) > 2 * CATALOG_BUCKET_SIZE:
+            self.buckets[index : index + 1] = [
+                bucket[:CATALOG_BUCKET_SIZE],
+                bucket[CATALOG_BUCKET_SIZE:],
+            ]
+            self.maxes[index : index + 1] = [
+                bucket[CATALOG_BUCKET_SIZE - 1],
+                bucket[-1],
+            ]
+            self._blobs[index : index + 1] = [None, None]
+
+    def remove(self, name: str) -> None:
+        index = bisect.bisect_left(self.maxes, name)
+        if index == len(self.maxes):
+            return
+        bucket = self.buckets[index]
+        position = bisect.bisect_left(bucket, name)
+        if position == len(bucket) or bucket[position] != name:
+            return
+        del bucket[position]
+        self.size -= 1
+        if bucket:
+            self.maxes[index] = bucket[-1]
+            self._blobs[index] = None
+        else:
+            del self.buckets[index]
+            del self.maxes[index]
+            del self._blobs[index]
+
+    def search(
+        self, mode: str, query: str, offset: int, limit: int
+    ) -> Tuple[int, List[str]]:
+        """Return the total number of matches and one page of the matching names in sorted order
+
+        Args:
+            mode (str): "prefix", "substring" or "glob"
+            query (str): prefix, substring or shell-style pattern (*, ?, [seq])
+            offset (int): number of matches to skip
+            limit (int): maximum number of names returned
+        """
+        if mode == "prefix":
+            lo = self._position(query)
+            hi = self._position(query + "\U0010ffff")
+            return hi - lo, self._slice(lo + offset, min(lo + offset + limit, hi))
+        if mode == "substring":
+            matches = self._find(query)
+        elif mode == "glob":
+            matches = self._glob(query)
+        else:
+            raise ValueError(f"Unknown search mode {mode}")
+
+        total = 0
+        page = []
+        for name in matches:
+            if offset <= total < offset + limit:
+                page.append(name)
+            total += 1
+        return total, page
+
+    def _position(self, name: str) -> int:
+        # Number of names of the index smaller than name
+        index = bisect.bisect_left(self.maxes, name)
+        position = sum(len(bucket) for bucket in self.buckets[:index])
+        if index < len(self.buckets):
+            position += bisect.bisect_left(self.buckets[index], name)
+        return position
+
+    def _slice(self, start: int, stop: int) -> List[str]:
+        # Names between two positions of the index
+        result = []
+        for bucket in self.buckets:
+            if start >= stop or stop <= 0:
+                break
+            if start < len(bucket):
+                result.extend(bucket[max(start, 0) : stop])
+            start -= len(bucket)
+            stop -= len(bucket)
+        return result
+
+    def _find(self, text: str):
+        # Yield the names containing text, scanning the joined names of each bucket at C speed
+        for index, bucket in enumerate(self.buckets):
+            blob = self._blobs[index]
+            if blob is None:
+                blob = self._blobs[index] = "\n".join(bucket)
+            position = blob.find(text) if text else 0
+            while position != -1 and position < len(blob):
+                start = blob.rfind("\n", 0, position) + 1
+                end = blob.find("\n", position)
+                end = len(blob) if end == -1 else end
+                yield blob[start:end]
+                position = blob.find(text, end + 1) if text else end + 1
+
+    def _glob(self, pattern: str):
+        # Yield the names matching a shell-style pattern, only testing the names that
+        # start with its literal prefix or contain its longest literal part
+        matcher = re.compile(fnmatch.translate(pattern)).match
+        literals = CatalogIndex.glob_literals(pattern)
+        if pattern.startswith(literals[0]) and literals[0]:
+            lo = self._position(literals[0])
+            hi = self._position(literals[0] + "\U0010ffff")
+            candidates = self._slice(lo, hi)
+        else:
+            candidates = self._find(max(literals, key=len))
+        for name in candidates:
+            if matcher(name):
+                yield name
+
+    @staticmethod
+    def glob_literals(pattern: str) -> List[str]:
+        # Split a shell-style pattern into the literal parts between its wildcards
+        literals = [""]
+        index = 0
+        while index < len(pattern):
+            char = pattern[index]
+            end = -1
+            if char == "[":
+                # Same rules as fnmatch: optional "!", then a "]" right after is literal
+                end = index + 1
+                if end < len(pattern) and pattern[end] == "!":
+                    end += 1
+                if end < len(pattern) and pattern[end] == "]":
+                    end += 1
+                end = pattern.find("]", end)
+            if char in "*?" or end != -1:
+                literals.append("")
+                index = end if end != -1 else index
+            else:
+                literals[-1] += char
+            index += 1
+        return literals
+
+
 class Tracker:
     def __init__(
-        self, host: str = "127.0.0.1", port: int = 8000, max_nodes: int = 10
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        max_nodes: int = 10,
+        metrics_port: int = None,
     ) -> None:
         """
         Initialize the tracker with the given host, port, and maximum number of nodes
-        and init the metainfo file for the tracker
+        and init the metainfo file for the tracker, metrics are served in the Prometheus
+        format on localhost:metrics_port if it is given
         """
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -70,7 +271,46 @@ class Tracker:
         self.sock.listen(max_nodes)
 
         self.peers: Dict[str, Peer] = {}
+        # Index from file name to the peers holding it, so fetch does not scan every peer
+        self.file_holders: Dict[str, Dict[str, Peer]] = {}
+        # Sorted index of the file names in file_holders, for discover and search
+        self.catalog = CatalogIndex()
+        # Versions of each file held by the live peers: file name -> version id -> file info
+        # with the piece hashes, which are kept once per version instead of once per peer
+        self.file_versions: Dict[str, Dict[str, Dict]] = {}
+        self.peers_lock = Lock()
+        # Min-heap of (expiry time, peer address), one entry per live peer
+        self.expiry_heap: List[Tuple[float, str]] = []
+        # Set when the tracker is closed, ends the serving and expiry loops
+        self.stopped = Event()
         self.node_serving_thread: Thread = Thread(target=self.node_serve, daemon=True)
+        self.expiry_thread: Thread = Thread(target=self.expire_peers, daemon=True)
+
+        self.metrics = MetricsRegistry()
+        self.requests = self.metrics.counter(
+            "tracker_requests_total", "Requests handled by command", ("command",)
+        )
+        self.request_time = self.metrics.histogram(
+            "tracker_request_seconds", "Time to handle a request", ("command",)
+        )
+        self.metainfo_update_time = self.metrics.histogram(
+            "tracker_metainfo_update_seconds", "Time to update metainfo.json"
+        )
+        self.expired_peers = self.metrics.counter(
+            "tracker_expired_peers_total", "Peers removed after their TTL"
+        )
+        self.metrics.gauge(
+            "tracker_peers", "Connected peers", callback=lambda: len(self.peers)
+        )
+        self.metrics.gauge(
+            "tracker_catalog_files",
+            "Files held by the connected peers",
+            callback=lambda: len(self.catalog),
+        )
+        self.metrics_server = (
+            MetricsServer(self.metrics, port=metrics_port) if metrics_port else None
+        )
+
         with open("metainfo.json", "w") as meta_file:
             tracker_addr = f"{self.sock.getsockname()[0]}:{self.sock.getsockname()[1]}"
             json.dump(
@@ -80,130 +320,325 @@ class Tracker:
             )
         print("[Tracker]: Tracker is running at", tracker_addr)
 
-    def start(self) -> None:
-        # Start the thread to accept incoming connections from peers
+    def start(self, shell: bool = True) -> None:
+        """
+        Start the threads accepting the peers and expiring them, then run the command shell
+
+        With shell=False the tracker serves in the background and start returns at once, so
+        a script can run it and stop it with close().
+        """
+        if self.metrics_server is not None:
+            self.metrics_server.start()
         self.node_serving_thread.start()
-        self.tracker_command_shell()
+        self.expiry_thread.start()
+        if shell:
+            self.tracker_command_shell()
 
     def node_serve(self) -> None:
         # Loop to accept incoming connections from peers
-        while True:
+        # The handshake is read by the thread of the connection, so a connection that
+        # says nothing never holds up the others
+        while not self.stopped.is_set():
             try:
                 node_socket, node_addr = self.sock.accept()
             except Exception as e:
                 continue
 
-            data = node_socket.recv(BUFFER_SIZE).decode()
-            if data == "First Connection":
-                try:
-                    peer_info: list[str] = (
-                        node_socket.recv(BUFFER_SIZE).decode().split(" ", 3)
-                    )
+            Thread(
+                target=self.join_node, args=[node_socket, node_addr], daemon=True
+            ).start()
 
-                    TrackerUtil.update_metainfo(
-                        json.loads(peer_info[3]), peer_info[0], int(peer_info[1])
-                    )
-
-                    peer_thread: Thread = Thread(
-                        target=self.handle_node_request,
-                        args=[node_socket, node_addr],
-                        daemon=True,
-                    )
+    def join_node(self, node_socket: socket.socket, node_addr: str) -> None:
+        # Read the handshake of a new connection, then handle the requests of the peer
+        # A connection without a handshake within HANDSHAKE_TIMEOUT seconds is closed
+        node_socket.settimeout(HANDSHAKE_TIMEOUT)
+        node_reader = node_socket.makefile("rb")
+        try:
+            data = TrackerUtil.recv_line(node_reader)
+        except OSError:
+            data = None
+        if data != "First Connection":
+            node_socket.close()
+            return
 
-                    self.peers[node_addr] = Peer(
-                        ip_address=peer_info[0],  # IP Address of the peer
-                        peer_socket=node_socket,  # Node socket for communication with that peer
-                        peer_thread=peer_thread,  # Thread for handling that peer
-                        peer_listening_port=int(
-                            peer_info[1]
-                        ),  # Listening port of the peer
-                        peer_upload_port=int(peer_info[2]),  # Upload port of the peer
-                        file_info=json.loads(
-                            peer_info[3]
-                        ),  # File information for the peer
-                    )
+        try:
+            peer_info: list[str] = TrackerUtil.recv_line(node_reader).split(" ", 3)
+
+            with self.metainfo_update_time.time():
+                TrackerUtil.update_metainfo(
+                    json.loads(peer_info[3]), peer_info[0], int(peer_info[1])
+                )
+
+            peer = Peer(
+                ip_address=peer_info[0],  # IP Address of the peer
+                peer_socket=node_socket,  # Node socket for communication with that peer
+                peer_thread=current_thread(),  # Thread for handling that peer
+                peer_listening_port=int(peer_info[1]),  # Listening port of the peer
+                peer_upload_port=int(peer_info[2]),  # Upload port of the peer
+                file_info=json.loads(peer_info[3]),  # File information for the peer
+            )
+            with self.peers_lock:
+                self.peers[node_addr] = peer
+                self.index_peer_files(node_addr, peer)
+                heapq.heappush(self.expiry_heap, (peer.expires_at, node_addr))
+
+            print(f"[Connection]: {peer_info[0]}:{peer_info[1]} joined the network")
+            TrackerUtil.send_line(node_socket, "Connected")
+        except Exception as e:
+            try:
+                TrackerUtil.send_line(
+                    node_socket,
+                    "Some error occurred while updating metadata on tracker",
+                )
+            except OSError:
+                pass
+            node_socket.close()
+            return
 
-                    print(
-                        f"[Connection]: {peer_info[0]}:{peer_info[1]} joined the network"
-                    )
-                    node_socket.send("Connected".encode())
-                    peer_thread.start()
-                except Exception as e:
-                    node_socket.send(
-                        "Some error occurred while updating metadata on tracker".encode()
-                    )
-                    node_socket.close()
+        # Peers are idle between heartbeats, they are expired by PEER_TTL instead
+        node_socket.settimeout(None)
+        self.handle_node_request(node_socket, node_reader, node_addr)
 
-    def handle_node_request(self, node_socket: socket.socket, node_addr: str) -> None:
+    def handle_node_request(
+        self, node_socket: socket.socket, node_reader, node_addr: str
+    ) -> None:
         # Handle the requests from the peer with the given socket and address (IP, port)
+        # Every request is a single line, so consecutive requests never get merged
         while True:
-            data = ""
             try:
-                data = node_socket.recv(BUFFER_SIZE).decode()
+                data = TrackerUtil.recv_line(node_reader)
             except Exception as e:
-                continue
+                data = None
+
+            if data is None:
+                # Connection was lost without a close message (or the peer was expired)
+                if node_addr in self.peers:
+                    print(f"[Close]: {node_addr[0]}:{node_addr[1]} disconnected")
+                    self.remove_peer(node_addr)
+                break
 
+            # Any message from the peer proves that it is still alive
+            self.touch_peer(node_addr)
             if data == "":
                 continue
 
             command, *args = data.split()
-            if command == "fetch":
-                self.fetch_response(node_socket, args)
+            command_label = (command if command in COMMANDS else "unknown",)
+            self.requests.inc(1, command_label)
+            start_time = time.perf_counter()
+            if command == "heartbeat":
+                pass
+            elif command == "fetch":
+                self.fetch_response(node_socket, node_addr, args)
             elif command == "close":
                 print(f"[Close]: {node_addr[0]}:{node_addr[1]} offline")
                 self.remove_peer(node_addr)
+                self.request_time.observe(
+                    time.perf_counter() - start_time, command_label
+                )
                 break
             elif command == "publish":
                 try:
-                    file_info = json.loads("".join(args))
-                    TrackerUtil.update_metainfo(
-                        file_info,
-                        self.peers[node_addr].ip_address,
-                        self.peers[node_addr].peer_listening_port,
-                    )
-                    self.peers[node_addr].file_info = file_info
-                    node_socket.send("OK".encode())
+                    file_info = json.loads(data.split(" ", 1)[1])
+                    with self.metainfo_update_time.time():
+                        TrackerUtil.update_metainfo(
+                            file_info,
+                            self.peers[node_addr].ip_address,
+                            self.peers[node_addr].peer_listening_port,
+                        )
+                    with self.peers_lock:
+                        peer = self.peers[node_addr]
+                        self.unindex_peer_files(node_addr, peer)
+                        peer.file_info = file_info
+                        self.index_peer_files(node_addr, peer)
+                    TrackerUtil.send_line(node_socket, "OK")
                 except Exception as e:
                     print(e)
-                    node_socket.send(
-                        "Some error occurred while updating metadata on tracker".encode()
+                    TrackerUtil.send_line(
+                        node_socket,
+                        "Some error occurred while updating metadata on tracker",
                     )
             elif command == "discover":
-                response = []
-                with open("metainfo.json", "r") as meta_file:
-                    meta_info = json.load(meta_file)
-                    for file_name, file_info in meta_info.items():
-                        response.append(file_name)
-                response.remove("tracker_addr")
-                node_socket.send(json.dumps(response).encode())
+                # Page through the whole catalog
+                self.search_response(node_socket, ["prefix", ""] + args)
+            elif command == "search":
+                self.search_response(node_socket, args)
+            self.request_time.observe(time.perf_counter() - start_time, command_label)
 
         node_socket.close()
 
-    def fetch_response(self, node_socket: socket.socket, files_name: str) -> None:
-        """Scan the file_info of all peers to find the requested files and send the response to the peer
+    def fetch_response(
+        self, node_socket: socket.socket, node_addr: str, args: List[str]
+    ) -> None:
+        """Send a bounded, locality-ranked sample of the peers holding each requested file
+
+        Peers are grouped by file so the node knows who holds what. Each file gets at most
+        `limit` peers starting at `offset` in a ranking that is stable for a given requester,
+        so the node can page through the holders of a popular file. Only the holders of the
+        latest version of a file are ranked, and the response carries the version id and the
+        piece hashes of that version, so a node with an older copy can fetch just the diff.
 
         Args:
             node_socket (socket.socket): socket for responding the peer
-            files_name (str): list of files that the peer want to fetch (fetch 3.txt 4.txt)
+            node_addr (str): key of the requesting peer in the peers dictionary
+            args (List[str]): request arguments (fetch [--offset=N] [--limit=N] 3.txt 4.txt)
         """
-        response = {}
-        response["exclude"] = []
+        offset, limit, files_name = TrackerUtil.parse_fetch_args(args)
+        requester = self.peers.get(node_addr)
+        requester_ip = requester.ip_address if requester else node_addr[0]
+
+        response = {"files": {}, "exclude": []}
         for file_name in files_name:
-            exist = False
-            for peer in self.peers.values():
-                if file_name in peer.file_info:
-                    exist = True
-                    response[f"{peer.ip_address}:{peer.peer_listening_port}"] = {
+            # Only the holders of the latest version are returned
+            with self.peers_lock:
+                holders_by_version: Dict[str, List[Peer]] = {}
+                for peer_addr, peer in self.file_holders.get(file_name, {}).items():
+                    if peer_addr != node_addr:
+                        holders_by_version.setdefault(
+                            TrackerUtil.version_key(
+                                peer.file_info[file_name].get("version")
+                            ),
+                            [],
+                        ).append(peer)
+                versions = self.file_versions.get(file_name, {})
+                version_id = max(
+                    holders_by_version,
+                    key=lambda version: versions[version]["modified"],
+                    default=None,
+                )
+                version = versions.get(version_id) if holders_by_version else None
+            if version is None:
+                response["exclude"].append(file_name)
+                continue
+            holders = holders_by_version[version_id]
+
+            ranked = TrackerUtil.rank_peers(
+                holders, requester_ip, f"{node_addr}/{file_name}", offset + limit
+            )
+            page = ranked[offset : offset + limit]
+            next_offset = offset + len(page)
+            response["files"][file_name] = {
+                "piece_count": version["piece_count"],
+                "file_size": version["file_size"],
+                "version": version_id,
+                "modified": version["modified"],
+                "piece_hashes": version["piece_hashes"],
+                "total": len(holders),
+                "offset": offset,
+                "next_offset": next_offset if next_offset < len(holders) else None,
+                "peers": [
+                    {
                         "peer_ip": f"{peer.ip_address}:{peer.peer_listening_port}",
                         "ip_addr": peer.ip_address,
                         "upload_port": peer.peer_upload_port,
                     }
-            if not exist:
-                response.setdefault("exclude", []).append(file_name)
+                    for peer in page
+                ],
+            }
         tracker_ip = self.sock.getsockname()[0]
         tracker_port = self.sock.getsockname()[1]
         response["tracker_ip"] = f"{tracker_ip}:{tracker_port}"
-        node_socket.send(json.dumps(response).encode())
+        TrackerUtil.send_json(node_socket, response)
+
+    def touch_peer(self, peer_addr: str) -> None:
+        """Push back the expiry time of the peer
+
+        The heap entry is not updated here, it is re-pushed lazily when it comes due,
+        so a heartbeat costs O(1) and the heap keeps a single entry per peer.
+        """
+        peer = self.peers.get(peer_addr)
+        if peer is not None:
+            peer.expires_at = time.monotonic() + PEER_TTL
+
+    def expire_peers(self) -> None:
+        # Loop to remove the peers that have not sent any message for PEER_TTL seconds
+        while not self.stopped.wait(EXPIRE_CHECK_INTERVAL):
+            expired = []
+            with self.peers_lock:
+                now = time.monotonic()
+                while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                    _, peer_addr = heapq.heappop(self.expiry_heap)
+                    peer = self.peers.get(peer_addr)
+                    if peer is None:
+                        continue
+                    if peer.expires_at > now:
+                        # The peer was seen since this entry was pushed
+                        heapq.heappush(self.expiry_heap, (peer.expires_at, peer_addr))
+                    else:
+                        expired.append(peer_addr)
+
+            for peer_addr in expired:
+                print(f"[Expire]: {peer_addr[0]}:{peer_addr[1]} timed out")
+                self.expired_peers.inc()
+                self.remove_peer(peer_addr)
+
+    def search_response(self, node_socket: socket.socket, args: List[str]) -> None:
+        """Send one page of the file names of the catalog matching the query
+
+        Args:
+            node_socket (socket.socket): socket for responding the peer
+            args (List[str]): request arguments (search <prefix|substring|glob> <query> [--offset=N] [--limit=N])
+        """
+        offset, limit, query = TrackerUtil.parse_page_args(
+            args, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE
+        )
+        try:
+            mode, pattern = query[0], " ".join(query[1:])
+            with self.peers_lock:
+                total, results = self.catalog.search(mode, pattern, offset, limit)
+        except (IndexError, ValueError, re.error) as e:
+            TrackerUtil.send_json(node_socket, {"error": f"Invalid search: {e}"})
+            return
+
+        next_offset = offset + len(results)
+        TrackerUtil.send_json(
+            node_socket,
+            {
+                "results": results,
+                "total": total,
+                "offset": offset,
+                "next_offset": next_offset if next_offset < total else None,
+            },
+        )
+
+    def index_peer_files(self, peer_addr: str, peer: Peer) -> None:
+        # Register the peer as a holder of each of its files (caller holds peers_lock)
+        for file_name, file_info in peer.file_info.items():
+            if file_name not in self.file_holders:
+                self.catalog.add(file_name)
+            self.file_holders.setdefault(file_name, {})[peer_addr] = peer
+
+            # The piece hashes move from the peer to the shared entry of the version
+            piece_hashes = file_info.pop("piece_hashes", [])
+            version = self.file_versions.setdefault(file_name, {}).setdefault(
+                TrackerUtil.version_key(file_info.get("version")),
+                {
+                    "file_size": file_info.get("file_size"),
+                    "piece_count": file_info.get("piece_count"),
+                    "modified": file_info.get("modified", 0),
+                    "piece_hashes": piece_hashes,
+                    "holders": 0,
+                },
+            )
+            version["holders"] += 1
+
+    def unindex_peer_files(self, peer_addr: str, peer: Peer) -> None:
+        # Remove the peer from the holders of each of its files (caller holds peers_lock)
+        for file_name, file_info in peer.file_info.items():
+            holders = self.file_holders.get(file_name)
+            if holders is None or holders.pop(peer_addr, None) is None:
+                continue
+            if not holders:
+                del self.file_holders[file_name]
+                self.catalog.remove(file_name)
+
+            versions = self.file_versions[file_name]
+            version_id = TrackerUtil.version_key(file_info.get("version"))
+            versions[version_id]["holders"] -= 1
+            if versions[version_id]["holders"] == 0:
+                del versions[version_id]
+                if not versions:
+                    del self.file_versions[file_name]
 
     def remove_peer(self, peer_addr: str) -> None:
         """Remove the peer with corresponding peer address from the tracker
@@ -211,15 +646,19 @@ class Tracker:
         Args:
             peer_addr (str): Key of the peer in the peers dictionary (str(Tuple(str, int)))
         """
-        if peer_addr in self.peers:
-            try:
-                self.peers[peer_addr].close()
-            except Exception as e:
-                print(f"[Error]: Failed to close peer at {peer_addr}: {e}")
-            finally:
-                del self.peers[peer_addr]
-        else:
+        with self.peers_lock:
+            peer = self.peers.pop(peer_addr, None)
+            if peer is not None:
+                self.unindex_peer_files(peer_addr, peer)
+
+        if peer is None:
             print(f"[Warning]: Peer {peer_addr} not found")
+            return
+        try:
+            with self.metainfo_update_time.time():
+                peer.close()
+        except Exception as e:
+            print(f"[Error]: Failed to close peer at {peer_addr}: {e}")
 
     def list_command_shell(self) -> None:
         """List all the peers that are currently connected to the tracker"""
@@ -231,10 +670,19 @@ class Tracker:
             print(f"- [{index}] {str(peer_addr)}")
 
     def tracker_command_shell(self) -> None:
-        """Command shell for interacting with the tracker (currently support list and exit)"""
+        """
+        Command shell for interacting with the tracker (currently support list, peer, stats and exit)
+
+        When the input ends (e.g the tracker runs in the background), the tracker keeps
+        serving until it is interrupted or closed.
+        """
         while True:
-            sock_name, sock_port = self.sock.getsockname()
-            cmd_input = input()
+            try:
+                cmd_input = input()
+            except EOFError:
+                print("[Tracker]: No more commands, serving until interrupted")
+                self.stopped.wait()
+                break
             cmd_parts = cmd_input.split()
 
             if not cmd_parts:
@@ -246,6 +694,8 @@ class Tracker:
                 case "peer":
                     for peer in self.peers.values():
                         print(peer)
+                case "stats":
+                    print(self.metrics.summary())
                 case "exit":
                     break
                 case _:
@@ -253,12 +703,92 @@ class Tracker:
 
     def close(self) -> None:
         """Close the tracker and all the peers connected to the tracker"""
+        self.stopped.set()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
         self.sock.close()
-        for peer in self.peers.values():
-            peer.close()
+        # remove_peer unindexes each peer under peers_lock before closing its socket, so the
+        # handler threads woken by the close find it gone and do not close it again
+        for peer_addr in list(self.peers):
+            self.remove_peer(peer_addr)
 
 
 class TrackerUtil:
+    @staticmethod
+    def recv_line(reader) -> str | None:
+        """Read a single newline-terminated message from the node
+
+        Returns:
+            str | None: message without the trailing newline, None if the connection is closed
+        """
+        line = reader.readline()
+        if not line:
+            return None
+        return line.decode().rstrip("\r\n")
+
+    @staticmethod
+    def send_line(sock: socket.socket, msg: str) -> None:
+        # Send a single newline-terminated message to the node
+        sock.sendall(f"{msg}\n".encode())
+
+    @staticmethod
+    def send_json(sock: socket.socket, obj) -> None:
+        # Send an object as a single line of JSON to the node
+        TrackerUtil.send_line(sock, json.dumps(obj))
+
+    @staticmethod
+    def parse_fetch_args(args: List[str]) -> Tuple[int, int, List[str]]:
+        """Split the fetch arguments into paging options and file names
+
+        Args:
+            args (List[str]): e.g ["--offset=20", "--limit=10", "3.txt", "4.txt"]
+
+        Returns:
+            Tuple[int, int, List[str]]: offset, limit and the requested file names
+        """
+        return TrackerUtil.parse_page_args(args, PEERS_PER_FILE, MAX_PEERS_PER_FILE)
+
+    @staticmethod
+    def parse_page_args(
+        args: List[str], default_limit: int, max_limit: int
+    ) -> Tuple[int, int, List[str]]:
+        # Split the --offset=N and --limit=N options from the other arguments
+        offset, limit, rest = 0, default_limit, []
+        for arg in args:
+            if arg.startswith("--offset="):
+                offset = max(0, int(arg.split("=", 1)[1]))
+            elif arg.startswith("--limit="):
+                limit = min(max(1, int(arg.split("=", 1)[1])), max_limit)
+            else:
+                rest.append(arg)
+        return offset, limit, rest
+
+    @staticmethod
+    def rank_peers(
+        peers: List[Peer], requester_ip: str, seed: str, count: int
+    ) -> List[Peer]:
+        """Return the first `count` peers ranked by locality to the requester
+
+        Peers on the same host come first, then peers on the same /24 subnet, then the rest.
+        Ties are broken by a pseudo-random order seeded by `seed`, so the ranking is random
+        across requesters but stable between pages of the same requester.
+        Selecting with a bounded heap costs O(n log count) instead of sorting all holders.
+        """
+        subnet = requester_ip.rsplit(".", 1)[0]
+        seed_hash = zlib.crc32(seed.encode())
+
+        def rank(peer: Peer) -> Tuple[int, int]:
+            if peer.ip_address == requester_ip:
+                locality = 0
+            elif peer.ip_address.rsplit(".", 1)[0] == subnet:
+                locality = 1
+            else:
+                locality = 2
+            address = f"{peer.ip_address}:{peer.peer_listening_port}"
+            return locality, zlib.crc32(address.encode(), seed_hash)
+
+        return heapq.nsmallest(count, peers, key=rank)
+
     @staticmethod
     def update_metainfo(
         file_info: Dict[str, int], ip_address: str, upload_port: int
@@ -270,24 +800,83 @@ class TrackerUtil:
             ip_address (str): IP address of the peer
             upload_port (int): Upload port of the peer
         """
+        with metainfo_lock:
+            TrackerUtil._update_metainfo(file_info, ip_address, upload_port)
+
+    @staticmethod
+    def _update_metainfo(
+        file_info: Dict[str, int], ip_address: str, upload_port: int
+    ) -> None:
+        # Every file entry keeps its versions (file info, piece hashes and holders) and the
+        # id of the latest one, a node announcing a version stops holding the others
         with open("metainfo.json", "r") as meta_file:
             meta_info = json.load(meta_file)
+            node_address = f"{ip_address}:{upload_port}"
             for file_name, file_info in file_info.items():
-                node_address = f"{ip_address}:{upload_port}"
-                if (
-                    file_name in meta_info
-                    and not node_address in meta_info[file_name]["nodes"]
-                ):
-                    meta_info[file_name]["nodes"].append(node_address)
-                elif file_name not in meta_info:
-                    meta_info[file_name] = file_info
-                    meta_info[file_name]["nodes"] = [node_address]
+                version_id = file_info.get("version")
+                if file_name in meta_info:
+                    TrackerUtil.remove_metainfo_node(
+                        meta_info, file_name, node_address, keep_version=version_id
+                    )
+                entry = meta_info.setdefault(
+                    file_name,
+                    {"version": TrackerUtil.version_key(version_id), "versions": {}},
+                )
+                version = entry["versions"].setdefault(
+                    TrackerUtil.version_key(version_id), dict(file_info, nodes=[])
+                )
+                if node_address not in version["nodes"]:
+                    version["nodes"].append(node_address)
+                entry["version"] = TrackerUtil.latest_version(entry["versions"])
 
         with open("metainfo.json", "w") as meta_file:
             json.dump(meta_info, meta_file, indent=3)
 
     @staticmethod
-    def cli_parser() -> Tuple[str, int, int]:
+    def remove_metainfo_node(
+        meta_info: Dict, file_name: str, node_address: str, keep_version: str = None
+    ) -> None:
+        """Remove the node from the holders of the versions of a file in the metainfo
+
+        Versions without holders are dropped, and so is the file without any version.
+
+        Args:
+            meta_info (Dict): content of metainfo.json
+            file_name (str): file name
+            node_address (str): ip:port of the node
+            keep_version (str): version id the node still holds, None to remove it from all
+        """
+        versions = meta_info[file_name]["versions"]
+        for version_id in list(versions):
+            nodes = versions[version_id]["nodes"]
+            if node_address not in nodes or (
+                keep_version is not None
+                and version_id == TrackerUtil.version_key(keep_version)
+            ):
+                continue
+            nodes.remove(node_address)
+            if not nodes:
+                del versions[version_id]
+        if versions:
+            meta_info[file_name]["version"] = TrackerUtil.latest_version(versions)
+        else:
+            del meta_info[file_name]
+
+    @staticmethod
+    def version_key(version_id: str | None) -> str:
+        # Key of a version among the versions of a file, in memory and in metainfo.json,
+        # "" for the files announced without a version id
+        return version_id or ""
+
+    @staticmethod
+    def latest_version(versions: Dict[str, Dict]) -> str:
+        # The latest version of a file is the one modified last
+        return max(
+            versions, key=lambda version_id: versions[version_id].get("modified", 0)
+        )
+
+    @staticmethod
+    def cli_parser() -> Tuple[str, int, int, int]:
         # Parse the command line arguments for the tracker
         parser = argparse.ArgumentParser(
             prog="Tracker", description="Init the tracker for file system"
@@ -309,8 +898,14 @@ class TrackerUtil:
             default=10,
             help="Maximum number of clients (default: 10)",
         )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=None,
+            help="Serve Prometheus metrics on 127.0.0.1:<port>/metrics (default: off)",
+        )
         args = parser.parse_args()
-        return (args.host, args.port, args.max_nodes)
+        return (args.host, args.port, args.max_nodes, args.metrics_port)
 
     @staticmethod
     def get_host_default_ip() -> str:
@@ -326,8 +921,8 @@ class TrackerUtil:
 
 
 def main() -> None:
-    host, port, max_nodes = TrackerUtil.cli_parser()
-    tracker = Tracker(host, port, max_nodes)
+    host, port, max_nodes, metrics_port = TrackerUtil.cli_parser()
+    tracker = Tracker(host, port, max_nodes, metrics_port)
     try:
         tracker.start()
     except KeyboardInterrupt: